@@ -0,0 +1,9 @@
+'''
+    The corad package, its modules pull in pyradiomics and SimpleITK, so they are only imported when used.
+'''
+
+
+def load_results(path) -> tuple:
+    """ Loads the (features, feature_names, cases) of a results file, see corad.results.load_results"""
+    from corad.results import load_results
+    return load_results(path)
@@ -1,13 +1,16 @@
+import functools
+import glob
+import importlib.util
 import os
 import multiprocessing as mp
+import re
+import threading
+from contextlib import closing
 import click
-from tqdm import tqdm
-
-import corad.radiomics_funcs as rf
-import corad.utilities as ut
 
 '''
-    This file defines the CLI functions using the Click library.
+    This file defines the CLI functions using the Click library. The corad modules pull in pyradiomics, SimpleITK and
+    lungmask, so they are imported inside the commands which need them and --help or cora clean start without them.
     Frank te Nijenhuis 2020
 '''
 
@@ -20,74 +23,422 @@ OUTPUT_CSV = os.path.join(ROOT, 'results.csv')
 
 # Setup other constants
 CPU_COUNT = mp.cpu_count()
+OUTPUT_FORMATS = ('csv', 'npz', 'parquet')
 
 
 @click.group()
-def cora():
+@click.option('--volume-cache', default=None, help='Directory for a cache of decoded volumes, which all commands read '
+                                                   'through. Disabled by default')
+@click.option('--volume-cache-size', default=50.0, type=click.FloatRange(min=0), help='Size limit of the volume cache '
+                                                                                      'in GB, least recently used '
+                                                                                      'volumes are evicted')
+def cora(volume_cache, volume_cache_size):
     """A CLI wrapper for Cora, COVID Radiomics"""
+    if volume_cache:
+        import corad.volume_cache as vc
+        vc.configure(volume_cache, volume_cache_size * 1024 ** 3)
 
 
 @cora.command()
 @click.option('-i', '--input-f', default=INPUT_CSV, help='Input file, containing list of files and corresponding '
-                                                         'masks, a third label column is optional')
+                                                         'masks, a third label column is optional. Can also be a '
+                                                         'directory or glob of case files, which may be compressed '
+                                                         'with gzip, bzip2 or xz')
 @click.option('-o', '--output-f', default=OUTPUT_CSV, help='Output target file')
-@click.option('-r', '--params', default=PARAMS, help='Parameter file, default params.yaml')
+@click.option('-r', '--params', default=[PARAMS], multiple=True, help='Parameter file, default params.yaml. Can be '
+                                                                      'given more than once, every case is then '
+                                                                      'extracted with every configuration while it is '
+                                                                      'loaded, and rows get a Config column with the '
+                                                                      'name of the parameter file')
+@click.option('--split-configs', is_flag=True, help='Write one output per parameter file, e.g. results.binwidth25.csv, '
+                                                    'instead of one output for all of them')
 @click.option('-l', '--log', default=LOG, help='Log location, default log.txt')
 @click.option('-p', '--parallel', default=False, type=bool, is_flag=True, help='Parallelization flag')
+@click.option('-w', '--workers', default=CPU_COUNT, type=click.IntRange(min=1), help='Number of worker processes used '
+                                                                                    'in parallel mode, default is the '
+                                                                                    'number of processors')
+@click.option('-k', '--chunk-size', default=1, type=click.IntRange(min=1), help='Number of cases sent to a worker at '
+                                                                                'once in parallel mode')
+@click.option('-f', '--flush-interval', default=1.0, type=click.FloatRange(min=0.01), help='Seconds between flushes '
+                                                                                         'of the output file')
+@click.option('-c', '--cache', default=False, is_flag=True, help='Keep results in a cache next to the output file and '
+                                                                 'skip cases which were extracted before')
+@click.option('--hash-content', default=False, is_flag=True, help='Identify cached files by a hash of their content '
+                                                                  'instead of their size and modification time')
+@click.option('--profile', default=False, is_flag=True, help='Record the time and memory of every extraction stage '
+                                                              'per case in a .profile.jsonl file next to the output, '
+                                                              'and print the slowest cases and stages')
+@click.option('-s', '--shard', default=None, help='Only extract shard i of N, given as i/N with i from 1 to N. Cases '
+                                                 'are divided over the shards by estimated cost, each shard writes '
+                                                 'its own output, which can be combined with cora merge')
+@click.option('-t', '--timings', default=None, help='Profile of a previous run, used to order cases by their measured '
+                                                   'time in parallel mode. By default the .profile.jsonl file next to '
+                                                   'the output is used if it exists, otherwise cases are ordered by '
+                                                   'size')
+@click.option('-m', '--filter-cache-size', default=None, type=click.FloatRange(min=0), help='Memory in GB per '
+                                                                                          'process for filtered '
+                                                                                          'images, which are shared '
+                                                                                          'by all masks of an image. '
+                                                                                          'By default a quarter of '
+                                                                                          'the physical memory is '
+                                                                                          'divided over the '
+                                                                                          'processes. 0 disables it')
+@click.option('-e', '--prefetch', default=2, type=click.IntRange(min=0), help='Number of image/mask pairs read ahead '
+                                                                             'in the background in serial mode, so '
+                                                                             'reads overlap with extraction. 0 '
+                                                                             'disables it')
+@click.option('--prefetch-memory', default=2.0, type=click.FloatRange(min=0), help='Memory in GB the pairs read ahead '
+                                                                                   'may take, estimated from their '
+                                                                                   'headers. The next pair is always '
+                                                                                   'read ahead')
+@click.option('--max-memory', default=None, type=click.FloatRange(min=0, min_open=True), help='Memory in GB the '
+                                                                                        'workers may use together in '
+                                                                                        'parallel mode. Cases are only '
+                                                                                        'started while their memory, '
+                                                                                        'estimated from the image '
+                                                                                        'headers, fits. By default '
+                                                                                        'all workers run at once')
+@click.option('--output-format', default='csv', type=click.Choice(OUTPUT_FORMATS), help='Also store the results as a '
+                                                                                     'feature matrix next to the csv '
+                                                                                     'output, e.g. results.npz, '
+                                                                                     'which loads without parsing. '
+                                                                                     'parquet requires pyarrow')
 @click.option('-b', '--label', default=1, type=int, help='The label to be used in the extraction, has to be valid for '
                                                          'all masks being used. Note that any label defined in the '
                                                          'input file takes precedence.')
-def run(input_f, output_f, params, log, parallel, label):
-    extract(input_f, output_f, params, log, parallel, label)
+def run(input_f, output_f, params, split_configs, log, parallel, workers, chunk_size, flush_interval, cache,
+        hash_content, profile, shard, timings, filter_cache_size, prefetch, prefetch_memory, max_memory, output_format,
+        label):
+    if output_format == 'parquet':
+        require_pyarrow('--output-format')
+    if shard:
+        import corad.scheduling as sch
+        try:
+            shard = sch.parse_shard(shard)
+        except ValueError as err:
+            raise click.BadParameter(str(err), param_hint='--shard')
+    extract(input_f, output_f, params, log, parallel, label, workers, chunk_size, flush_interval, cache, hash_content,
+            profile, shard, timings, gigabytes(filter_cache_size), prefetch, int(prefetch_memory * 1024 ** 3),
+            split_configs, gigabytes(max_memory), output_format)
+
+
+def gigabytes(value):
+    """ Converts an optional size in GB to bytes, None stays None"""
+    return int(value * 1024 ** 3) if value is not None else None
+
+
+def require_pyarrow(param_hint):
+    """ Fails before any work is done if the Parquet format is requested without pyarrow installed"""
+    # Only looked up, importing pyarrow would add its startup time to the run
+    if importlib.util.find_spec('pyarrow') is None:
+        raise click.BadParameter('the parquet format requires pyarrow, install it with pip install pyarrow',
+                                 param_hint=param_hint)
+
+
+def parameter_configs(params) -> dict:
+    """
+    Names parameter files after their file name, e.g. binwidth25 for binwidth25.yaml. A single parameter file gets no
+    name, so its output keeps the columns of a plain run.
+    """
+    if isinstance(params, str):
+        params = [params]
+    if len(params) == 1:
+        return {None: params[0]}
+    configs = {}
+    for path in params:
+        config = os.path.splitext(os.path.basename(path))[0]
+        if config in configs:
+            raise click.BadParameter('{} and {} are both named {}'.format(configs[config], path, config),
+                                     param_hint='--params')
+        configs[config] = path
+    return configs
+
 
+def result_caches(out_paths: dict, extractors: dict, hash_content: bool) -> dict:
+    """ Opens the result cache next to the output of every configuration"""
+    from corad.cache import ResultCache, settings_hash
+    # Every configuration has its own settings hash, so configurations sharing an output also share its cache
+    return {config: ResultCache(out_paths[config] + '.cache.sqlite', settings_hash(extractor), hash_content)
+            for config, extractor in extractors.items()}
+
+
+def extract(input_f, output_f, params, log, parallel, label, workers=CPU_COUNT, chunk_size=1, flush_interval=1.0,
+            use_cache=False, hash_content=False, profile=False, shard=None, timings=None, filter_cache_size=None,
+            prefetch=2, prefetch_memory=2 * 1024 ** 3, split_configs=False, max_memory=None, output_format='csv'):
+    """
+    Extracts the features for all cases in input_f with every parameter file in params, returns the number of
+    successfully extracted rows. Rows served from the result cache are written but not counted. Without a
+    filter_cache_size, every extracting process gets its share of the default budget.
+    """
+    from tqdm import tqdm
+    import corad.filter_cache as fc
+    import corad.radiomics_funcs as rf
+    import corad.scheduling as sch
+    import corad.utilities as ut
+    from corad.profiling import CaseProfiler, ProfileSink, install_hooks
+    from corad.writer import ResultWriter, config_output
 
-def extract(input_f, output_f, params, log, parallel, label):
     # Write logs to logfile, set verbosity
     lgr = rf.setup_logger(log)
 
     # Setting for extractor are defined in params.yaml, files to process are defined in cases.csv
-    f_extractor = rf.initialize_extractor(params, lgr)
-    file_list = ut.read_files(input_f, lgr)
+    configs = parameter_configs(params)
+    extractors = rf.initialize_extractors(configs, lgr)
+    if filter_cache_size is None:
+        filter_cache_size = fc.default_size(workers if parallel else 1)
+    for config, extractor in extractors.items():
+        if filter_cache_size and not fc.shareable(extractor.settings):
+            click.echo("Filter cache not used{}, images are resampled or cropped to each mask before filtering".format(
+                ' for ' + config if config else ''))
+    if not split_configs and not rf.same_columns(extractors):
+        click.echo("The parameter files enable different features, writing one output per parameter file")
+        split_configs = True
+    n_cases, missing = ut.validate_cases(input_f, lgr)
+    click.echo("Input: {} cases, {} missing files".format(n_cases, len(missing)))
+    # Case files are streamed, consecutive rows sharing an image and mask are extracted together, so each volume is
+    # only loaded once
+    case_groups = rf.iter_groups(ut.iter_cases(input_f, lgr))
+    if shard:
+        index, count = shard
+        try:
+            assignment = sch.shard_assignment(rf.iter_groups(ut.iter_cases(input_f, lgr)), count)
+        except RuntimeError as err:
+            raise click.ClickException(str(err))
+        case_groups = sch.select_shard(case_groups, assignment, index - 1)
+        n_cases = assignment.count(index - 1)
+        click.echo("Shard {} of {}: {} cases".format(index, count, n_cases))
+
+    out_paths = {}
+    for config in configs:
+        out_path = config_output(output_f, config) if split_configs and config else output_f
+        out_paths[config] = sch.shard_output(out_path, *shard) if shard else out_path
+    click.echo("Writing to {}".format(', '.join(sorted(set(out_paths.values())))))
+    if shard:
+        output_f = sch.shard_output(output_f, *shard)
+
+    caches = result_caches(out_paths, extractors, hash_content) if use_cache else {}
 
+    # Every group keeps its position in the case file, the writer uses it to write the results in that order. Rows
+    # found in the result cache are written without extracting them again
+    tasks = enumerate(case_groups)
+    profile_path = output_f + '.profile.jsonl'
+    # Read the timings of the previous run before this run appends to the same profile
+    previous = sch.load_timings(timings or profile_path) if parallel else None
+    profile_sink = ProfileSink(profile_path) if profile else None
+    extracted = 0
+    n_cached = 0
+    signatures = {}
+
+    # A single writer process owns the output files, extraction only puts rows on its queue. When extraction fails the
+    # writer is stopped as well, it would otherwise keep the process from exiting
+    writer = ResultWriter(out_paths, flush_interval, cache=caches or None)
     if parallel:
         click.echo("Parallel mode enabled")
-        click.echo("Number of processors: {}".format(mp.cpu_count()))
-        click.echo("Extracting features")
-        pool = mp.Pool(CPU_COUNT)
-        prog_bar = tqdm(total=len(file_list))
-
-        # Perform the feature calculation and return vector of features
-        result_objects = [pool.apply_async(rf.extract_features, args=(file, f_extractor, output_f, label),
-                                           callback=lambda _: prog_bar.update(1)) for file in file_list]
-        # Unpack the worker results back into desired features
-        features = [r.get() for r in result_objects]
-        features = [i for i in features if i]
-
-        # Cleanup after parallel work
-        pool.close()
-        pool.join()
+        click.echo("Number of workers: {}".format(workers))
+        if max_memory:
+            click.echo("Memory budget: {:.1f} GB".format(max_memory / 1024 ** 3))
+    click.echo("Extracting features")
+    try:
+        with writer, tqdm(total=n_cases) as prog_bar:
+            if parallel:
+                # Groups sharing an image go to the same worker, so it can reuse the filtered images, and the largest
+                # bundles go first, so no large case is left running on its own at the end of the run
+                bundles = sch.dispatch_order(rf.iter_bundles(tasks), previous)
+                # Chunks of bundles are sent to a worker at once
+                bundles = ([task for bundle in chunk for task in bundle] for chunk in sch.chunks(bundles, chunk_size))
+                # Every worker builds its own extractor, so only the case groups and their indices are sent with each
+                # task. The pool is closed before the writer, so running workers can hand over their rows
+                initargs = (configs, writer.queue, label, profile, caches, filter_cache_size)
+                with closing(rf.pool_results(bundles, workers, initargs, writer.queue, max_memory)) as results:
+                    for n_groups, n_written, n_from_cache, records in results:
+                        writer.check()
+                        extracted += n_written - n_from_cache
+                        n_cached += n_from_cache
+                        prog_bar.update(n_groups)
+                        if profile_sink:
+                            profile_sink.add(records)
+            else:
+                fc.enable(filter_cache_size)
+                if profile:
+                    install_hooks()
+                if prefetch:
+                    # The next pairs are read in the background while the current one is extracted, cached groups are
+                    # skipped. Their file signatures are kept for the extraction, so files are only hashed once
+                    def skip(index, group):
+                        signatures[index] = rf.group_signatures(group, caches)
+                        return rf.fully_cached(group, caches, label, signatures[index])
+                    tasks = rf.prefetch_volumes(tasks, prefetch, prefetch_memory, skip if caches else None)
+                else:
+                    tasks = ((index, group, None) for index, group in tasks)
+                for index, group, volumes in tasks:
+                    profiler = CaseProfiler(group[0], group[1]) if profile else None
+                    rows = rf.extract_features(group, extractors, writer.queue, label, lgr, profiler, index, caches,
+                                               volumes, signatures.pop(index, None))
+                    writer.check()
+                    extracted += len(rows) - rf.count_cached(rows)
+                    n_cached += rf.count_cached(rows)
+                    prog_bar.update(1)
+                    if profile_sink:
+                        profile_sink.add(profiler.records)
+    finally:
+        for result_cache in caches.values():
+            result_cache.close()
+        if profile_sink:
+            profile_sink.close()
+    if output_format != 'csv':
+        from corad.results import convert_results, results_output
+        # The csv stays the output which is cached, merged and appended to, the matrix is written from it at the end
+        for out_path in sorted(set(out_paths.values())):
+            n_rows = convert_results(out_path, results_output(out_path, output_format), output_format)
+            click.echo("{} rows stored in {}".format(n_rows, results_output(out_path, output_format)))
+    if caches:
+        click.echo("Rows served from cache: {}".format(n_cached))
+    if profile_sink:
+        click.echo(profile_sink.summary())
+        click.echo("Profile written to {}".format(profile_sink.out_path))
+    return extracted
+
+
+@cora.command()
+@click.argument('source')
+@click.option('-o', '--output-f', default=OUTPUT_CSV, help='Output target file, new rows are appended to it')
+@click.option('-r', '--params', default=[PARAMS], multiple=True, help='Parameter file, default params.yaml. Can be '
+                                                                      'given more than once, rows then get a Config '
+                                                                      'column with the name of the parameter file')
+@click.option('-l', '--log', default=LOG, help='Log location, default log.txt')
+@click.option('-w', '--workers', default=CPU_COUNT, type=click.IntRange(min=1), help='Number of worker processes, '
+                                                                                    'default is the number of '
+                                                                                    'processors')
+@click.option('-n', '--interval', default=2.0, type=click.FloatRange(min=0.1), help='Seconds between polls of the '
+                                                                                   'source when nothing is new')
+@click.option('-c', '--cache', default=False, is_flag=True, help='Keep results in a cache next to the output file')
+@click.option('--hash-content', default=False, is_flag=True, help='Identify cached files by a hash of their content')
+@click.option('-m', '--filter-cache-size', default=None, type=click.FloatRange(min=0), help='Memory in GB per '
+                                                                                          'process for filtered '
+                                                                                          'images, by default a '
+                                                                                          'quarter of the physical '
+                                                                                          'memory is divided over '
+                                                                                          'the workers')
+@click.option('--max-memory', default=None, type=click.FloatRange(min=0, min_open=True), help='Memory in GB the '
+                                                                                        'workers may use together')
+@click.option('-b', '--label', default=1, type=int, help='The label to be used in the extraction, a label column in '
+                                                         'the case file takes precedence')
+def watch(source, output_f, params, log, workers, interval, cache, hash_content, filter_cache_size, max_memory, label):
+    """
+    Keeps extracting new cases until interrupted. SOURCE is an inbox directory, in which an image x.nii.gz is paired
+    with the mask x_mask.nii.gz, or an append-only case file. The extractors and worker pool stay loaded between cases,
+    cases already in the output are skipped. On Ctrl-C or SIGTERM the cases in progress are finished and written.
+    """
+    import signal
+    import corad.filter_cache as fc
+    import corad.radiomics_funcs as rf
+    import corad.watch as wt
+    from corad.writer import ResultWriter, config_output
+
+    lgr = rf.setup_logger(log)
+    configs = parameter_configs(params)
+    extractors = rf.initialize_extractors(configs, lgr)
+    filter_cache_size = gigabytes(filter_cache_size)
+    if filter_cache_size is None:
+        filter_cache_size = fc.default_size(workers)
+    if rf.same_columns(extractors):
+        out_paths = {config: output_f for config in configs}
     else:
-        features = list()
-        click.echo("Extracting features")
-        for file in tqdm(file_list):
-            result = rf.extract_features(file, f_extractor, output_f, label, lgr)
-            if result:
-                features.append(result)
-    return features
+        click.echo("The parameter files enable different features, writing one output per parameter file")
+        out_paths = {config: config_output(output_f, config) for config in configs}
+    caches = result_caches(out_paths, extractors, hash_content) if cache else {}
+    done = set.intersection(*(wt.written_cases(out_path) for out_path in set(out_paths.values())))
+    if os.path.isdir(source):
+        poll = functools.partial(wt.new_inbox_cases, source, done)
+    else:
+        tail = wt.ManifestTail(source)
+        poll = lambda: [row for row in tail.read_new() if (row[0], row[1]) not in done]
+
+    # The handlers are installed before the writer and workers are forked, so they inherit them and keep running on a
+    # Ctrl-C sent to the whole process group, only the main process stops taking new cases
+    stop = threading.Event()
+    main_pid = os.getpid()
+
+    def request_stop(*_):
+        if os.getpid() == main_pid and not stop.is_set():
+            click.echo("Stopping, finishing the cases in progress")
+            stop.set()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, request_stop)
+
+    writer = ResultWriter(out_paths, cache=caches or None)
+    click.echo("Watching {} with {} workers, writing to {}".format(source, workers,
+                                                                      ', '.join(sorted(set(out_paths.values())))))
+    n_cases = n_rows = 0
+    try:
+        with writer:
+            initargs = (configs, writer.queue, label, False, caches, filter_cache_size)
+            bundles = wt.watch_bundles(poll, interval, stop)
+            max_memory = gigabytes(max_memory)
+            with closing(rf.pool_results(bundles, workers, initargs, writer.queue, max_memory)) as results:
+                for n_groups, n_written, _, _ in results:
+                    writer.check()
+                    n_cases += n_groups
+                    n_rows += n_written
+                    click.echo("{} cases extracted, {} rows".format(n_cases, n_rows))
+    finally:
+        for result_cache in caches.values():
+            result_cache.close()
+    click.echo("Stopped after {} cases".format(n_cases))
 
 
 @cora.command()
 def test():
     """ Runs a test case using simple parameters"""
+    import corad.utilities as ut
     ut.create_input_names(INPUT_CSV, ut.write_simple, False)
     temp_label = 1
     extract(INPUT_CSV, OUTPUT_CSV, PARAMS, LOG, False, temp_label)
 
 
 @cora.command()
-def masks():
-    target = os.path.join(os.getcwd(), 'data/UMCG/RAW')
-    ut.create_masks(target)
+@click.option('-n', '--cases', 'n_cases', default=4, type=click.IntRange(min=1), help='Number of synthetic cases')
+@click.option('-s', '--shape', default='64x256x256', help='Size of the synthetic volumes as ZxYxX')
+@click.option('-w', '--workers', default=CPU_COUNT, type=click.IntRange(min=1), help='Number of worker processes')
+@click.option('-r', '--params', default=PARAMS, help='Parameter file, default params.yaml')
+@click.option('-o', '--output-f', default=os.path.join(ROOT, 'bench.json'), help='Benchmark report, in json')
+@click.option('-d', '--work-dir', default=None, help='Directory to keep the synthetic cohort in, by default a '
+                                                     'temporary directory is used and removed afterwards')
+@click.option('--startup', is_flag=True, help='Only measure the startup time of every command, and which heavy '
+                                              'modules it imports before doing any work')
+def bench(n_cases, shape, workers, params, output_f, work_dir, startup):
+    """ Benchmarks extraction and sampling on synthetic phantoms"""
+    import corad.bench as bm
+    if startup:
+        report = bm.bench_startup()
+        bm.write_report(report, output_f)
+        for command, stats in report['startup'].items():
+            click.echo("{:<10}{:>8.3f} s  {}".format(command or '--help', stats['seconds'],
+                                                     ' '.join(stats['heavy_modules'])))
+        click.echo("Report written to {}".format(output_f))
+        return
+    try:
+        shape = tuple(int(size) for size in shape.lower().split('x'))
+    except ValueError:
+        raise click.BadParameter('Expected a size like 64x256x256', param_hint='--shape')
+    report = bm.run_benchmarks(n_cases, shape, workers, params, work_dir)
+    bm.write_report(report, output_f)
+    for stage, stats in report.items():
+        if stage != 'config':
+            click.echo("{:<18}{:>10.2f} s{:>12.2f} items/s".format(stage, stats['seconds'], stats['items_per_s'] or 0))
+    click.echo("Report written to {}".format(output_f))
+
+
+@cora.command()
+@click.option('-t', '--target', default=os.path.join(ROOT, 'data/UMCG/RAW'), help='Directory containing the dcm series')
+@click.option('-o', '--output-dir', default=None, help='Directory for the masks, default is Masks within the target')
+@click.option('-j', '--jobs', default=1, type=click.IntRange(min=1), help='Number of series processed concurrently')
+@click.option('-n', '--threads', default=None, type=click.IntRange(min=1), help='Inference threads per job')
+@click.option('-f', '--prefetch', default=2, type=click.IntRange(min=1), help='Number of series read ahead per job')
+def masks(target, output_dir, jobs, threads, prefetch):
+    """ Creates lung lobe masks for all dcm series, skipping series which already have a mask"""
+    import corad.utilities as ut
+    ut.create_masks(target, output_dir, jobs, threads, prefetch)
 
 
 @cora.command()
@@ -98,6 +449,7 @@ def masks():
 @click.option('-s', '--sampled', is_flag=True, help="If set will write subsampled cases")
 def cases(output_f, case_type, sampled):
     """ Creates a case file .csv based on the type of dataset being analyzed"""
+    import corad.utilities as ut
     if case_type == 'medseg':
         ut.create_input_names(output_f, ut.write_medseg, sampled)
     elif case_type == 'simple':
@@ -110,6 +462,41 @@ def cases(output_f, case_type, sampled):
         ut.create_input_names(output_f, ut.write_UMCG_D, sampled)
 
 
+@cora.command()
+@click.argument('inputs', nargs=-1)
+@click.option('-o', '--output-f', default=OUTPUT_CSV, help='Merged output file, by default the shard outputs of this '
+                                                          'file are merged when no inputs are given')
+def merge(inputs, output_f):
+    """ Combines shard outputs into one results file, without duplicate rows"""
+    import corad.scheduling as sch
+    from corad.writer import merge_results
+    if not inputs:
+        inputs = glob.glob(sch.shard_output(output_f, '*', '*'))
+    inputs = sorted(inputs, key=lambda path: [int(part) if part.isdigit() else part
+                                              for part in re.split(r'(\d+)', path)])
+    if not inputs:
+        raise click.UsageError('No result files to merge')
+    n_rows = merge_results(inputs, output_f)
+    click.echo("Merged {} files, {} rows written to {}".format(len(inputs), n_rows, output_f))
+
+
+@cora.command()
+@click.argument('inputs', nargs=-1)
+@click.option('-f', '--output-format', default='npz', type=click.Choice(OUTPUT_FORMATS[1:]), help='Format to convert '
+                                                                                                  'to, parquet '
+                                                                                                  'requires pyarrow')
+def export(inputs, output_format):
+    """ Converts results files to a feature matrix, e.g. results.csv to results.npz, by default results.csv"""
+    if output_format == 'parquet':
+        require_pyarrow('--output-format')
+    from corad.results import convert_results, results_output
+    for in_path in inputs or [OUTPUT_CSV]:
+        if not os.path.isfile(in_path):
+            raise click.UsageError('No results file {}'.format(in_path))
+        n_rows = convert_results(in_path, results_output(in_path, output_format), output_format)
+        click.echo("{} rows converted to {}".format(n_rows, results_output(in_path, output_format)))
+
+
 @cora.command()
 @click.confirmation_option(prompt='Are you sure you want to remove all .csv files?')
 def clean():
@@ -124,17 +511,34 @@ def clean():
 @cora.command()
 @click.option('-i', '--input-f', default=INPUT_CSV, help='Input file, containing list of files and corresponding '
                                                          'masks, a third label column is optional')
-def sample(input_f):
+@click.option('-w', '--workers', default=CPU_COUNT, type=click.IntRange(min=1), help='Number of worker processes')
+@click.option('-m', '--combined', is_flag=True, help='Write one compressed mask holding all sampled labels, instead of '
+                                                     'one mask per label')
+@click.option('-s', '--seed', default=None, type=int, help='Seed for the random window positions')
+def sample(input_f, workers, combined, seed):
+    """ Samples a fixed size window per slice for every label in the masks"""
+    import corad.radiomics_funcs as rf
+    import corad.utilities as ut
     lgr = rf.setup_logger(LOG)
     file_list = ut.read_files(input_f, lgr)
-    rf.sample_masks(file_list)
+    rf.sample_masks(file_list, workers, combined, seed)
 
 
 @cora.command()
-def convert():
+@click.option('-i', '--input-f', default=INPUT_CSV, help='Input file, containing list of files and corresponding '
+                                                         'masks')
+@click.option('-w', '--workers', default=CPU_COUNT, type=click.IntRange(min=1), help='Number of worker processes')
+@click.option('-c', '--window-center', default=None, type=float, help='Center of the intensity window, e.g. -600 HU. '
+                                                                      'Without a window the volume is min-max '
+                                                                      'normalized')
+@click.option('-d', '--window-width', default=None, type=float, help='Width of the intensity window, e.g. 1500 HU')
+@click.option('-e', '--skip-empty', is_flag=True, help='Only write slices in which the mask is not empty')
+def convert(input_f, workers, window_center, window_width, skip_empty):
     """ This command is used to prepare for CNN processing, by converting everything to png files."""
-    lgr = rf.setup_logger('log.txt')
-    ut.convert_nifti_to_png(ut.read_files(INPUT_CSV, lgr))
+    import corad.radiomics_funcs as rf
+    import corad.utilities as ut
+    lgr = rf.setup_logger(LOG)
+    ut.convert_nifti_to_png(ut.read_files(input_f, lgr), workers, window_center, window_width, skip_empty)
 
 
 def main():
@@ -0,0 +1,307 @@
+import ast
+import csv
+import importlib
+import inspect
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+from collections import OrderedDict
+
+import numpy as np
+import SimpleITK as sitk
+
+import corad.radiomics_funcs as rf
+import corad.utilities as ut
+from corad.writer import ResultWriter
+
+'''
+    This file contains a benchmark suite on synthetic CT phantoms, timing the extraction and sampling hot paths.
+'''
+
+# Hounsfield units of the phantom tissues
+AIR_HU = -1000
+BODY_HU = 40
+LUNG_HU = -850
+NOISE_HU = 30
+
+# Lobes of the phantom masks, the left lung has two lobes and the right lung three, like the lungmask output
+LOBES = 5
+PERCENTILES = (50, 90, 99)
+
+# Modules which take seconds to import, the CLI should only load them in the commands which use them
+HEAVY_MODULES = ('radiomics', 'SimpleITK', 'scipy', 'lungmask', 'torch', 'tensorflow')
+# Commands whose startup is measured, the empty command is cora --help
+STARTUP_COMMANDS = ('', 'run', 'watch', 'cases', 'merge', 'export', 'clean', 'sample', 'convert', 'masks', 'bench')
+
+# Loads the CLI and runs the import statements of a command, given as a json list, then reports which heavy modules
+# were imported on the way. Modules which aren't installed are skipped, as the command would fail on them
+_STARTUP_PROBE = """
+import json, sys
+import corad.__main__
+for statement in json.loads(sys.argv[1]):
+    try:
+        exec(statement)
+    except ImportError:
+        pass
+print(json.dumps(sorted(name for name in {} if name in sys.modules)))
+""".format(HEAVY_MODULES)
+
+
+def make_phantom(shape: tuple, spacing: tuple = (0.7, 0.7, 1.5), seed=None) -> tuple:
+    """
+    Creates a synthetic chest CT of shape (z, y, x) with a matching lobe mask. The body is an elliptic cylinder holding
+    two ellipsoid lungs, which are cut along z into lobes labeled 1 to 5. Returns the image and mask as sitk images.
+    """
+    rng = np.random.default_rng(seed)
+    depth, height, width = shape
+    z, y, x = np.ogrid[:depth, :height, :width]
+    zc, yc = (z - depth / 2) / (depth / 2), (y - height / 2) / (height / 2)
+
+    body = np.broadcast_to((yc / 0.8) ** 2 + ((x - width / 2) / (width * 0.45)) ** 2 <= 1, shape)
+    lungs = []
+    for side in (-1, 1):
+        xc = (x - width / 2 - side * width * 0.2) / (width * 0.15)
+        lungs.append(zc ** 2 / 0.9 + (yc / 0.6) ** 2 + xc ** 2 <= 1)
+
+    image = np.where(body, BODY_HU, AIR_HU).astype(np.float32)
+    mask = np.zeros(shape, dtype=np.uint8)
+    # Left lung gets lobes 1 and 2, the right lung lobes 3 to 5, split at equal depths
+    for lung, first, count in ((lungs[0], 1, 2), (lungs[1], 3, 3)):
+        lobe = np.broadcast_to(np.minimum(z * count // depth, count - 1) + first, shape)
+        mask[lung] = lobe[lung]
+        image[lung] = LUNG_HU
+    image += rng.normal(0, NOISE_HU, shape).astype(np.float32)
+
+    image_img = sitk.GetImageFromArray(image.astype(np.int16))
+    mask_img = sitk.GetImageFromArray(mask)
+    for img in (image_img, mask_img):
+        img.SetSpacing(spacing[::-1])
+    return image_img, mask_img
+
+
+def write_cohort(out_dir, n_cases: int, shape: tuple, seed=None) -> str:
+    """ Writes n_cases phantoms as compressed NIfTI and a case file with a row per lobe, returns the case file path"""
+    os.makedirs(out_dir, exist_ok=True)
+    seeds = np.random.SeedSequence(seed).spawn(n_cases)
+    cases_path = os.path.join(out_dir, 'cases.csv')
+    with open(cases_path, 'w') as out_file:
+        writer = csv.DictWriter(out_file, fieldnames=['Image', 'Mask', 'Label'])
+        writer.writeheader()
+        for i, case_seed in enumerate(seeds):
+            image, mask = make_phantom(shape, seed=case_seed)
+            image_path = os.path.join(out_dir, 'phantom_{:04d}.nii.gz'.format(i))
+            mask_path = os.path.join(out_dir, 'phantom_{:04d}_mask.nii.gz'.format(i))
+            sitk.WriteImage(image, image_path, True)
+            sitk.WriteImage(mask, mask_path, True)
+            for lobe in range(1, LOBES + 1):
+                writer.writerow({'Image': image_path, 'Mask': mask_path, 'Label': lobe})
+    return cases_path
+
+
+def peak_rss_kb() -> dict:
+    """
+    Peak resident set size of this process and of its finished children over their lifetime so far, in kB. It can't be
+    reset, so a benchmark only raises it if it needs more memory than every benchmark before it.
+    """
+    return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}
+
+
+def summarize(seconds: float, items: int, voxels: int = None, latencies: list = None) -> OrderedDict:
+    """ Turns a timing into throughput figures, with latency percentiles if per item latencies are given"""
+    stats = OrderedDict([('seconds', seconds), ('items', items), ('items_per_s', items / seconds if seconds else None)])
+    if voxels is not None:
+        stats['voxels_per_s'] = voxels / seconds if seconds else None
+    if latencies:
+        for p, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+            stats['latency_p{}'.format(p)] = float(value)
+    stats['lifetime_peak_rss_kb'] = peak_rss_kb()
+    return stats
+
+
+class _ListQueue(list):
+    """ Stands in for the writer queue when timing extraction of single cases"""
+    put = list.append
+
+
+def bench_read_files(cases_path) -> OrderedDict:
+    start = time.perf_counter()
+    file_list = ut.read_files(cases_path, logging.getLogger(__name__))
+    return summarize(time.perf_counter() - start, len(file_list))
+
+
+def bench_extract_cases(cases_path, params, voxels: int) -> OrderedDict:
+    """ Times extract_features per image/mask group in this process, giving the per case latency"""
+    logger = logging.getLogger(__name__)
+    extractor = rf.initialize_extractor(params, logger)
+    groups = rf.group_cases(ut.read_files(cases_path, logger))
+    latencies = []
+    rows = 0
+    for group in groups:
+        start = time.perf_counter()
+        rows += len(rf.extract_features(group, {None: extractor}, _ListQueue(), 1, logger))
+        latencies.append(time.perf_counter() - start)
+    return summarize(sum(latencies), rows, voxels * len(groups), latencies)
+
+
+def bench_extract(cases_path, out_dir, params, parallel: bool, workers: int, voxels: int, n_cases: int) -> OrderedDict:
+    """ Times a complete run of the extract command, including the writer process"""
+    # Imported here, the CLI module itself imports this module
+    from corad.__main__ import extract
+    output = os.path.join(out_dir, 'results_{}.csv'.format('parallel' if parallel else 'serial'))
+    start = time.perf_counter()
+    rows = extract(cases_path, output, params, os.path.join(out_dir, 'log.txt'), parallel, 1, workers)
+    return summarize(time.perf_counter() - start, rows, voxels * n_cases)
+
+
+def bench_roi_sampling(cases_path, voxels: int) -> OrderedDict:
+    masks = list(OrderedDict.fromkeys(row[1] for row in ut.read_files(cases_path, logging.getLogger(__name__))))
+    latencies = []
+    for i, mask_path in enumerate(masks):
+        mask = sitk.ReadImage(mask_path)
+        start = time.perf_counter()
+        rf.ROI_sampling(mask, seed=i)
+        latencies.append(time.perf_counter() - start)
+    return summarize(sum(latencies), len(masks), voxels * len(masks), latencies)
+
+
+def bench_sample_masks(cases_path, workers: int, voxels: int, n_cases: int) -> OrderedDict:
+    file_list = ut.read_files(cases_path, logging.getLogger(__name__))
+    start = time.perf_counter()
+    rf.sample_masks(file_list, workers, combined=True, seed=0)
+    return summarize(time.perf_counter() - start, n_cases, voxels * n_cases)
+
+
+def bench_writer(out_dir, n_rows: int, n_features: int = 1000) -> OrderedDict:
+    """ Times the result writer on synthetic rows shaped like pyradiomics output"""
+    features = OrderedDict(('original_feature_{}'.format(i), np.float64(i) / 7) for i in range(n_features))
+    start = time.perf_counter()
+    with ResultWriter(os.path.join(out_dir, 'writer.csv')) as writer:
+        for i in range(n_rows):
+            writer.queue.put((i, [('image_{}.nii.gz'.format(i), 'mask_{}.nii.gz'.format(i), 1, features, None, None)]))
+    return summarize(time.perf_counter() - start, n_rows)
+
+
+def _bind_import(node, namespace: dict):
+    """ Adds the names bound by an import statement to namespace, names which can't be imported are left out"""
+    for alias in node.names:
+        try:
+            if isinstance(node, ast.Import):
+                module = importlib.import_module(alias.name)
+                namespace[alias.asname or alias.name.split('.')[0]] = (
+                    module if alias.asname else importlib.import_module(alias.name.split('.')[0]))
+            else:
+                module = importlib.import_module(node.module)
+                name = alias.asname or alias.name
+                namespace[name] = (getattr(module, alias.name) if hasattr(module, alias.name)
+                                   else importlib.import_module('{}.{}'.format(node.module, alias.name)))
+        except ImportError:
+            pass
+
+
+def _import_statement(node) -> list:
+    """ Returns an import statement as source, one per imported name"""
+    if isinstance(node, ast.Import):
+        return ['import {}'.format(alias.name) for alias in node.names]
+    return ['from {} import {}'.format(node.module, alias.name) for alias in node.names]
+
+
+def command_imports(command: str) -> list:
+    """
+    Returns the import statements a cora command runs, as source. Commands import their modules inside their function,
+    so these are collected from the command and from the functions of corad it calls, following the calls down.
+    Conditional imports are included, the result is what a run with every option imports.
+    """
+    from corad.__main__ import cora
+    if not command:
+        return []
+    statements = []
+    todo = [cora.commands[command].callback]
+    seen = set()
+    while todo:
+        func = todo.pop()
+        if func in seen:
+            continue
+        seen.add(func)
+        tree = ast.parse(textwrap.dedent(inspect.getsource(func)))
+        namespace = dict(func.__globals__)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import) or (isinstance(node, ast.ImportFrom) and not node.level):
+                statements += [statement for statement in _import_statement(node) if statement not in statements]
+                _bind_import(node, namespace)
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Call):
+                continue
+            # Calls like extract(...) or rf.extract_features(...), anything else isn't followed
+            if isinstance(node.func, ast.Name):
+                callee = namespace.get(node.func.id)
+            elif isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name):
+                callee = getattr(namespace.get(node.func.value.id), node.func.attr, None)
+            else:
+                continue
+            if inspect.isfunction(callee) and callee.__module__.startswith('corad'):
+                todo.append(callee)
+    return statements
+
+
+def bench_startup(commands: tuple = STARTUP_COMMANDS, repeats: int = 5) -> OrderedDict:
+    """
+    Times a fresh interpreter loading the CLI and running the imports of cora <command>, which is the import cost every
+    invocation of the command pays before doing any work. The empty command is cora --help. Reports the median wall
+    time and the heavy modules the command imported.
+    """
+    startup = OrderedDict()
+    for command in commands:
+        args = [sys.executable, '-c', _STARTUP_PROBE, json.dumps(command_imports(command))]
+        latencies = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            probe = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                                   check=True)
+            latencies.append(time.perf_counter() - start)
+        startup[command] = OrderedDict([('seconds', float(np.median(latencies))),
+                                        ('heavy_modules', json.loads(probe.stdout.splitlines()[-1]))])
+    return OrderedDict([('config', OrderedDict([('repeats', repeats), ('python', platform.python_version())])),
+                        ('startup', startup)])
+
+
+def run_benchmarks(n_cases: int, shape: tuple, workers: int, params, work_dir=None, seed=0) -> OrderedDict:
+    """
+    Generates a synthetic cohort and times every hot path on it. Returns a report which can be dumped as json, all
+    timings are in seconds and throughput is in cases (or rows) and voxels per second.
+    """
+    keep = work_dir is not None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='cora_bench_')
+    voxels = int(np.prod(shape))
+    report = OrderedDict()
+    report['config'] = OrderedDict([('cases', n_cases), ('shape', list(shape)), ('workers', workers),
+                                    ('params', params), ('cpu_count', os.cpu_count()),
+                                    ('python', platform.python_version()), ('platform', platform.platform())])
+    try:
+        start = time.perf_counter()
+        cases_path = write_cohort(work_dir, n_cases, shape, seed)
+        report['generate'] = summarize(time.perf_counter() - start, n_cases, voxels * n_cases)
+        report['read_files'] = bench_read_files(cases_path)
+        report['extract_cases'] = bench_extract_cases(cases_path, params, voxels)
+        report['extract_serial'] = bench_extract(cases_path, work_dir, params, False, workers, voxels, n_cases)
+        report['extract_parallel'] = bench_extract(cases_path, work_dir, params, True, workers, voxels, n_cases)
+        report['roi_sampling'] = bench_roi_sampling(cases_path, voxels)
+        report['sample_masks'] = bench_sample_masks(cases_path, workers, voxels, n_cases)
+        report['result_writer'] = bench_writer(work_dir, n_cases * LOBES * 20)
+    finally:
+        if not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def write_report(report: OrderedDict, out_path):
+    with open(out_path, 'w') as out_file:
+        json.dump(report, out_file, indent=2)
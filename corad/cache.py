@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+
+'''
+    This file contains the persistent result cache, which lets reruns skip cases that were already extracted.
+'''
+
+# Files are hashed in blocks of this size when content hashing is enabled
+HASH_BLOCK = 1 << 20
+
+# Open connections per process and database file, caches of several configurations in one file share a connection
+_connections = {}
+
+
+def settings_hash(extractor) -> str:
+    """ Hashes everything that determines the output of an extractor, together with the pyradiomics version"""
+    import radiomics
+    config = {'version': radiomics.__version__, 'settings': extractor.settings,
+              'imageTypes': extractor.enabledImagetypes, 'features': extractor.enabledFeatures}
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_signature(path, content: bool = False) -> str:
+    """
+    Identifies the current version of a file, either by its absolute path, size and modification time or by a hash of
+    its content. Different scans of the same size can share a modification time, e.g. when unpacked from an archive,
+    so only the content hash leaves the path out, which lets moved or copied files hit the cache.
+    """
+    if content:
+        digest = hashlib.sha1()
+        with open(path, 'rb') as in_file:
+            for block in iter(lambda: in_file.read(HASH_BLOCK), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    stat = os.stat(path)
+    return '{}:{}:{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def case_signatures(image, mask, content: bool = False):
+    """ Returns the signatures of the image and mask of a case, or None if one of them can't be read"""
+    try:
+        return file_signature(image, content), file_signature(mask, content)
+    except OSError:
+        return None
+
+
+class ResultCache:
+    """
+    SQLite store of extracted feature rows, keyed on the image and mask files, the label and the extractor settings.
+    The connection is opened lazily and only lives in the process that opened it, so the cache can be handed to
+    another process.
+    """
+
+    def __init__(self, db_path, settings_key: str, hash_content: bool = False):
+        self.db_path = db_path
+        self.settings_key = settings_key
+        self.hash_content = hash_content
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        key = (os.getpid(), self.db_path)
+        if key not in _connections:
+            conn = sqlite3.connect(self.db_path, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, image TEXT, mask TEXT, '
+                         'label INTEGER, features TEXT)')
+            _connections[key] = conn
+        return _connections[key]
+
+    def signatures(self, image, mask):
+        """ Signatures of an image/mask pair as this cache identifies files, computed once for all labels of a pair"""
+        return case_signatures(image, mask, self.hash_content)
+
+    def key(self, signatures, label: int):
+        """ Returns the cache key of a label of a pair with the given signatures, or None if they couldn't be read"""
+        if signatures is None:
+            return None
+        parts = list(signatures) + [str(label), self.settings_key]
+        return hashlib.sha1('|'.join(parts).encode()).hexdigest()
+
+    def get(self, key):
+        """ Returns the stored features of a key, in their original column order, or None"""
+        if key is None:
+            return None
+        row = self.connection.execute('SELECT features FROM results WHERE key = ?', (key,)).fetchone()
+        return OrderedDict(json.loads(row[0])) if row else None
+
+    def put(self, key, image, mask, label: int, features):
+        """ Stores a feature row, values are kept in the form in which they are written to the csv output"""
+        if key is None:
+            return
+        values = json.dumps([(name, str(value)) for name, value in features.items()])
+        self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                                (key, image, mask, label, values))
+
+    def commit(self):
+        conn = _connections.get((os.getpid(), self.db_path))
+        if conn is not None:
+            conn.commit()
+
+    def close(self):
+        conn = _connections.pop((os.getpid(), self.db_path), None)
+        if conn is not None:
+            conn.commit()
+            conn.close()
@@ -1,8 +1,13 @@
+import hashlib
+import json
+import logging
+import os
+
 import numpy as np
-from keras.utils import np_utils
-from keras_preprocessing.image import ImageDataGenerator
-import corad.ild_cnn.cnn_model as CNN
 import tensorflow as tf
+import corad.ild_cnn.cnn_model as CNN
+import corad.utilities as ut
+from corad import volume_cache as vc
 
 train_params = {
      'do' : 0.5,        # Dropout Parameter
@@ -20,52 +25,114 @@ train_params = {
      'res_alias':  'res'      # csv results filename alias
 }
 
-datagen = ImageDataGenerator()
+# Settings of the input pipeline, slices are resized to the target size and windowed to lung tissue
+data_params = {
+    'cases': 'cases.csv',       # Case file listing the image/mask pairs
+    'cache_dir': 'data/cnn_cache',  # On-disk cache of decoded slices, one per split
+    'target_size': (512, 512),  # Slice size fed to the network
+    'window': (-600, 1500),     # Intensity window center and width in HU
+    'val_fraction': 0.2,        # Fraction of the cases used for validation
+    'batch_size': 32,
+    'epochs': 100,
+    'shuffle_buffer': 1024,     # Number of slices shuffled together
+    'parallel_cases': 4,        # Cases decoded at once, every one holds a whole volume as float32 in memory
+    'seed': 0,
+}
 
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+NB_CLASSES = 2
+# Settings which change the cached slices, a cache built with other values is not reused
+CACHED_PARAMS = ('target_size', 'window')
 
-def run_cnn():
-    t_g, v_g = prepare_data_loaders()
-    x_train, y_train = t_g.next()
-    x_val, y_val = v_g.next()
 
-    # labels to categorical vectors
-    uniquelbls = np.unique(y_train)
-    nb_classes = uniquelbls.shape[0]
-    zbn = np.min(uniquelbls) # zero based numbering
-    y_train = np_utils.to_categorical(y_train-zbn, nb_classes)
-    y_val = np_utils.to_categorical(y_val-zbn, nb_classes)
+def decode_case(image_path, mask_path, label):
+    """
+    Reads an image/mask pair and returns its windowed slices as (z, y, x, 1) floats in [0, 1], with a per slice class
+    which is 1 if the slice contains the label and 0 otherwise.
+    """
+    image, _ = vc.read_array(image_path.decode())
+    mask, _ = vc.read_array(mask_path.decode())
+    center, width = data_params['window']
+    slices = ut.window_intensity(image, center, width).astype(np.float32)[..., np.newaxis] / 255
+    classes = (mask == label).reshape(mask.shape[0], -1).any(axis=1).astype(np.int32)
+    return slices, classes
+
 
-    CNN.train(x_train, y_train, x_val, y_val, params=train_params)
+def _case_slices(image_path, mask_path, label):
+    slices, classes = tf.numpy_function(decode_case, [image_path, mask_path, label], (tf.float32, tf.int32))
+    slices.set_shape([None, None, None, 1])
+    classes.set_shape([None])
+    return tf.data.Dataset.from_tensor_slices((slices, classes))
 
 
+def _prepare_slice(image_slice, cls):
+    return tf.image.resize(image_slice, data_params['target_size']), tf.one_hot(cls, NB_CLASSES)
 
-def prepare_data_loaders():
-    train_generator = datagen.flow_from_directory(directory='data/rp_im', color_mode='grayscale',
-                                                  target_size=(512, 512),
-                                                  class_mode='binary')
-    validation_generator = datagen.flow_from_directory(directory='data/rp_im', color_mode='grayscale',
-                                                       target_size=(512, 512), class_mode='binary')
-    return train_generator, validation_generator
-
-
-run_cnn()
-
-"""
-def prepare_file(file_path, mask_path):
-    
-    # loading mnist dataset
-    (X_train, y_train), (X_val, y_val) = mnist.load_data()
-
-    # adding a singleton dimension and rescale to [0,1]
-    X_train = np.asarray(np.expand_dims(X_train, 1)) / float(255)
-    X_val = np.asarray(np.expand_dims(X_val, 1)) / float(255)
-
-    # labels to categorical vectors
-    uniquelbls = np.unique(y_train)
-    nb_classes = uniquelbls.shape[0]
-    zbn = np.min(uniquelbls)  # zero based numbering
-    y_train = np_utils.to_categorical(y_train - zbn, nb_classes)
-    y_val = np_utils.to_categorical(y_val - zbn, nb_classes)
-
-    return (X_train, y_train), (X_val, y_val)
+
+def cache_path(cases: list, name: str) -> str:
+    """
+    Returns the cache file of a split, named after the split and a hash of its cases and of the settings shaping the
+    slices, so a changed case file or window never reads the slices of another run.
+    """
+    key = json.dumps([[list(case) for case in cases], [data_params[param] for param in CACHED_PARAMS]])
+    return os.path.join(data_params['cache_dir'], '{}-{}'.format(name, hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+
+def make_dataset(cases: list, name: str, shuffle: bool) -> tf.data.Dataset:
     """
+    Builds a streaming dataset of slices for a list of (image, mask, label) cases. Cases are decoded in parallel, the
+    decoded slices are cached on disk after the first epoch and batches are prefetched while the model trains.
+    """
+    if not cases:
+        raise ValueError('No cases in the {} set'.format(name))
+    images, masks, labels = zip(*cases)
+    labels = [int(label) if label else 1 for label in labels]
+    dataset = tf.data.Dataset.from_tensor_slices((list(images), list(masks), labels))
+    if shuffle:
+        dataset = dataset.shuffle(len(cases), seed=data_params['seed'], reshuffle_each_iteration=True)
+    dataset = dataset.interleave(_case_slices, cycle_length=data_params['parallel_cases'],
+                                 num_parallel_calls=AUTOTUNE)
+    dataset = dataset.map(_prepare_slice, num_parallel_calls=AUTOTUNE)
+
+    os.makedirs(data_params['cache_dir'], exist_ok=True)
+    dataset = dataset.cache(cache_path(cases, name))
+    if shuffle:
+        dataset = dataset.shuffle(data_params['shuffle_buffer'], seed=data_params['seed'])
+    return dataset.batch(data_params['batch_size']).prefetch(AUTOTUNE)
+
+
+def split_cases(cases: list) -> tuple:
+    """
+    Splits the cases in a training and validation set, per image so slices of one scan never end up in both. Both sets
+    get at least one image, so at least two images are needed.
+    """
+    images = sorted(set(case[0] for case in cases))
+    if len(images) < 2:
+        raise ValueError('Splitting cases needs at least 2 images, got {}'.format(len(images)))
+    rng = np.random.default_rng(data_params['seed'])
+    rng.shuffle(images)
+    n_val = min(max(1, int(len(images) * data_params['val_fraction'])), len(images) - 1)
+    val_images = set(images[:n_val])
+    train = [case for case in cases if case[0] not in val_images]
+    val = [case for case in cases if case[0] in val_images]
+    return train, val
+
+
+def prepare_data_loaders():
+    cases = ut.read_files(data_params['cases'], logging.getLogger(__name__))
+    train_cases, val_cases = split_cases(cases)
+    return make_dataset(train_cases, 'train', True), make_dataset(val_cases, 'validation', False)
+
+
+def run_cnn():
+    train_ds, val_ds = prepare_data_loaders()
+    input_shape = (*data_params['target_size'], 1)
+    model = CNN.get_model(input_shape, (NB_CLASSES,), train_params)
+    early_stopping = tf.keras.callbacks.EarlyStopping(patience=train_params['patience'], restore_best_weights=True)
+    # Train over the full dataset in epochs, the validation split is evaluated after every epoch
+    model.fit(train_ds, validation_data=val_ds, epochs=data_params['epochs'], callbacks=[early_stopping])
+    return model
+
+
+if __name__ == '__main__':
+    run_cnn()
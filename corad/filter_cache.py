@@ -0,0 +1,188 @@
+import json
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+from corad.cache import file_signature
+
+'''
+    This file contains the in-memory cache of filtered images, which lets all masks of an image share its filtered
+    images within a process.
+'''
+
+# LBP3D uses the mask, and the Original image is not computed, so neither is cached
+UNCACHED_TYPES = ('LBP3D', 'Original')
+# Settings describing the mask rather than the filter, left out of the cache key
+MASK_SETTINGS = ('label', 'label_channel')
+# By default the filtered images of all processes may take this share of the physical memory, a wavelet of a CT scan
+# alone is 8 images of the size of the scan
+MEMORY_SHARE = 0.25
+# Budget per process if the physical memory is unknown
+FALLBACK_SIZE = 1024 ** 3
+
+# The cache of this process, and the image the filters currently run on, set by enable and image
+_cache = None
+_image_key = None
+
+
+class FilterCache:
+    """
+    Least recently used cache of the outputs of image filters, within a budget of max_bytes. Every image a filter
+    yields is an entry of its own, so a filter with more outputs than fit in the budget is still partly served from it.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # Number of images every filter yields, and how many of them are cached
+        self._lengths = {}
+        self._counts = {}
+
+    def length(self, key):
+        """ Returns the number of images the filter of key yields, or None if it never ran to the end"""
+        return self._lengths.get(key)
+
+    def set_length(self, key, n_items: int):
+        # Only kept while images of the filter are cached, it is forgotten with the last of them
+        if key in self._counts:
+            self._lengths[key] = n_items
+
+    def get(self, key, position: int):
+        entry = self._entries.get((key, position))
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end((key, position))
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, position: int, item: tuple, n_bytes: int):
+        if n_bytes > self.max_bytes:
+            return
+        previous = self._entries.pop((key, position), None)
+        if previous is None:
+            self._counts[key] = self._counts.get(key, 0) + 1
+        else:
+            self.n_bytes -= previous[1]
+        self._entries[(key, position)] = (item, n_bytes)
+        self.n_bytes += n_bytes
+        while self.n_bytes > self.max_bytes:
+            (evicted_key, _), (_, evicted) = self._entries.popitem(last=False)
+            self.n_bytes -= evicted
+            self._counts[evicted_key] -= 1
+            if not self._counts[evicted_key]:
+                del self._counts[evicted_key]
+                self._lengths.pop(evicted_key, None)
+
+
+def default_size(processes: int = 1) -> int:
+    """ Budget per process, a share of the physical memory divided over the processes extracting features"""
+    try:
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return FALLBACK_SIZE
+    return int(total * MEMORY_SHARE / processes)
+
+
+def image_bytes(image) -> int:
+    return image.GetNumberOfPixels() * image.GetNumberOfComponentsPerPixel() * image.GetSizeOfPixelComponent()
+
+
+def shareable(settings: dict) -> bool:
+    """
+    Filters run on the full image as loaded by pyradiomics, unless it is resampled or cropped around the mask while
+    loading. Only then are the filtered images the same for every mask of an image.
+    """
+    resampled = settings.get('interpolator') is not None and settings.get('resampledPixelSpacing') is not None
+    return not resampled and not settings.get('preCrop', False)
+
+
+def enable(max_bytes: int = None):
+    """
+    Enables the cache in this process, it is only used for extractor settings which are shareable. Without max_bytes
+    the budget is the default of a single process.
+    """
+    global _cache
+    if max_bytes is None:
+        max_bytes = default_size()
+    if max_bytes <= 0:
+        _cache = None
+        return
+    _cache = FilterCache(max_bytes)
+    install_hooks()
+
+
+@contextmanager
+def image(path):
+    """ Marks the image file all filters run on within the block, its filtered images are kept under this file"""
+    global _image_key
+    try:
+        _image_key = file_signature(path)
+    except OSError:
+        _image_key = None
+    try:
+        yield
+    finally:
+        _image_key = None
+
+
+def _cached_filter(func, image_type):
+    """
+    Replays the filtered images of the current image from the cache, running the filter only as far as the last image
+    which isn't cached. The images it yields are stored one by one while passing them on, so as many of them are kept
+    as fit in the cache.
+    """
+    @wraps(func)
+    def cached(inputImage, inputMask, **kwargs):
+        # The filter settings include the extractor settings, so every configuration is checked on its own
+        if _cache is None or _image_key is None or not shareable(kwargs):
+            yield from func(inputImage, inputMask, **kwargs)
+            return
+        settings = {name: value for name, value in kwargs.items() if name not in MASK_SETTINGS}
+        key = (_image_key, image_type, json.dumps(settings, sort_keys=True, default=str))
+        n_items = _cache.length(key)
+        # The cached images are taken up front, so storing the images computed below can't evict them
+        items = [_cache.get(key, position) for position in range(n_items or 0)]
+        missing = [position for position, item in enumerate(items) if item is None]
+        if n_items is None or missing:
+            n_run = missing[-1] + 1 if missing else None
+            outputs = func(inputImage, inputMask, **kwargs)
+            position = 0
+            try:
+                for position, item in enumerate(outputs, 1):
+                    n_bytes = image_bytes(item[0])
+                    # Images computed again only take free space, evicting the cached images after them would
+                    # make the next mask compute those again
+                    if n_items is None or _cache.n_bytes + n_bytes <= _cache.max_bytes:
+                        _cache.put(key, position - 1, item, n_bytes)
+                    yield item
+                    if position == n_run:
+                        break
+            finally:
+                outputs.close()
+            if n_items is None:
+                _cache.set_length(key, position)
+                return
+            items = items[n_run:]
+        # The settings passed on with a filtered image still describe the mask it was first computed for
+        mask_settings = {name: kwargs[name] for name in MASK_SETTINGS if name in kwargs}
+        for filtered, name, item_kwargs in items:
+            yield filtered, name, dict(item_kwargs, **mask_settings)
+    return cached
+
+
+def install_hooks():
+    """ Wraps the pyradiomics image filters, installed once per process"""
+    from radiomics import imageoperations, getImageTypes
+    if getattr(imageoperations, '_cora_filter_cache', False):
+        return
+    for image_type in getImageTypes():
+        if image_type in UNCACHED_TYPES:
+            continue
+        func_name = 'get{}Image'.format(image_type)
+        setattr(imageoperations, func_name, _cached_filter(getattr(imageoperations, func_name), image_type))
+    imageoperations._cora_filter_cache = True
@@ -0,0 +1,215 @@
+import heapq
+import json
+import os
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+'''
+    This file contains the opt-in per case, per stage profiler of the extraction.
+'''
+
+# Pyradiomics preprocessing functions which are timed as a stage of their own
+TIMED_OPERATIONS = {'resampleImage': 'resample', 'checkMask': 'check_mask', 'cropToTumorMask': 'crop',
+                    'getMask': 'get_mask', 'normalizeImage': 'normalize'}
+
+# Stages recorded by extract_features itself, together they make up the time of a case
+CASE_STAGES = ('read', 'extract', 'emit')
+
+# The profiler of the case currently being extracted in this process, set by CaseProfiler.activate
+_active = None
+# Peak resident set size in kB of every stage open in this process, the innermost last
+_open_peaks = []
+
+
+def rss_kb() -> int:
+    """ Current resident set size of this process in kB"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        return 0
+
+
+def _peak_rss_kb() -> int:
+    """ Peak resident set size of this process in kB since the peak was last reset"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def _checkpoint() -> bool:
+    """
+    Adds the peak since the previous checkpoint to every open stage, then resets the peak of the process to its
+    current size. Returns False if the peak can't be reset, which needs Linux.
+    """
+    peak = _peak_rss_kb()
+    for i, stage_peak in enumerate(_open_peaks):
+        _open_peaks[i] = max(stage_peak, peak)
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class CaseProfiler:
+    """
+    Records the wall time and memory of every stage of one image/mask group. Records are plain dicts, so a pool worker
+    can send them back with its result. rss_kb is the resident set size at the end of a stage and peak_rss_kb the
+    highest one during the stage, including its nested stages. The peak is None where it can't be reset per stage.
+    """
+
+    def __init__(self, image, mask):
+        self.image = image
+        self.mask = mask
+        self.label = ''
+        self.records = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        measured = _checkpoint()
+        _open_peaks.append(rss_kb())
+        try:
+            yield
+        finally:
+            measured = _checkpoint() and measured
+            peak = _open_peaks.pop()
+            self.records.append(OrderedDict([
+                ('image', self.image), ('mask', self.mask), ('label', self.label), ('stage', name),
+                ('seconds', time.perf_counter() - start), ('rss_kb', rss_kb()),
+                ('peak_rss_kb', peak if measured else None), ('pid', os.getpid())]))
+
+    @contextmanager
+    def activate(self):
+        """ Makes the pyradiomics hooks record into this profiler"""
+        global _active
+        _active = self
+        try:
+            yield self
+        finally:
+            _active = None
+
+
+@contextmanager
+def no_stage(_=None):
+    """ Stands in for CaseProfiler.stage and CaseProfiler.activate when profiling is off"""
+    yield
+
+
+def _record(name):
+    return _active.stage(name) if _active is not None else no_stage()
+
+
+def _timed_function(func, name):
+    @wraps(func)
+    def timed(*args, **kwargs):
+        with _record(name):
+            return func(*args, **kwargs)
+    return timed
+
+
+def _timed_generator(func, name):
+    """ Filters are generators, the time spent producing every filtered image is attributed to the filter"""
+    @wraps(func)
+    def timed(*args, **kwargs):
+        generator = func(*args, **kwargs)
+        while True:
+            with _record(name):
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+            yield item
+    return timed
+
+
+def _timed_feature_class(cls, name):
+    class TimedFeatureClass(cls):
+        def __init__(self, *args, **kwargs):
+            with _record(name):
+                super().__init__(*args, **kwargs)
+
+        def execute(self):
+            with _record(name):
+                return super().execute()
+    # pyradiomics names the logger of a feature class after its module and name, which keeps it below the radiomics
+    # logger and its level and handlers
+    TimedFeatureClass.__name__ = cls.__name__
+    TimedFeatureClass.__qualname__ = cls.__qualname__
+    TimedFeatureClass.__module__ = cls.__module__
+    return TimedFeatureClass
+
+
+def install_hooks():
+    """
+    Wraps the pyradiomics preprocessing functions, image filters and feature classes, so their time is recorded by the
+    active profiler. Installed once per process, the hooks do nothing while no profiler is active.
+    """
+    from radiomics import featureextractor, imageoperations, getFeatureClasses, getImageTypes
+    if getattr(featureextractor, '_cora_profiled', False):
+        return
+    for func_name, stage in TIMED_OPERATIONS.items():
+        setattr(imageoperations, func_name, _timed_function(getattr(imageoperations, func_name), stage))
+    for image_type in getImageTypes():
+        func_name = 'get{}Image'.format(image_type)
+        setattr(imageoperations, func_name,
+                _timed_generator(getattr(imageoperations, func_name), 'filter:' + image_type))
+    timed_classes = {name: _timed_feature_class(cls, 'features:' + name) for name, cls in getFeatureClasses().items()}
+    featureextractor.getFeatureClasses = lambda: timed_classes
+    featureextractor._cora_profiled = True
+
+
+class ProfileSink:
+    """
+    Appends profile records to a jsonl sidecar file and keeps the totals needed for the summary. Only the slowest top
+    cases and a few sums per stage are kept, so the memory use does not grow with the number of cases.
+    """
+
+    def __init__(self, out_path, top: int = 10):
+        self.out_path = out_path
+        self.top = top
+        self._out_file = open(out_path, 'a')
+        self.slowest = []
+        # Count, total and maximum seconds of every stage
+        self.stages = defaultdict(lambda: [0, 0.0, 0.0])
+
+    def add(self, records: list):
+        """ Adds the records of one or more image/mask groups"""
+        case_seconds = defaultdict(float)
+        for record in records:
+            self._out_file.write(json.dumps(record) + '\n')
+            totals = self.stages[record['stage']]
+            totals[0] += 1
+            totals[1] += record['seconds']
+            totals[2] = max(totals[2], record['seconds'])
+            # Nested stages are part of the extract stage, only the outer stages make up the case total
+            if record['stage'] in CASE_STAGES:
+                case_seconds[(record['image'], record['mask'])] += record['seconds']
+        for case, seconds in case_seconds.items():
+            if len(self.slowest) < self.top:
+                heapq.heappush(self.slowest, (seconds, case))
+            else:
+                heapq.heappushpop(self.slowest, (seconds, case))
+
+    def close(self):
+        self._out_file.close()
+
+    def summary(self) -> str:
+        """ Formats tables of the slowest cases and of the stages sorted by total time"""
+        lines = ['Slowest cases:', '{:>10}  {}'.format('seconds', 'case')]
+        for seconds, (image, mask) in sorted(self.slowest, reverse=True):
+            lines.append('{:>10.2f}  {} {}'.format(seconds, image, mask))
+        lines += ['', 'Stages:', '{:<28}{:>8}{:>12}{:>10}{:>10}'.format('stage', 'count', 'total s', 'mean s', 'max s')]
+        stages = sorted(self.stages.items(), key=lambda item: item[1][1], reverse=True)
+        for stage, (count, total, longest) in stages:
+            lines.append('{:<28}{:>8}{:>12.2f}{:>10.3f}{:>10.3f}'.format(stage, count, total, total / count, longest))
+        return '\n'.join(lines)
@@ -1,15 +1,23 @@
-import csv
+import json
 import logging
+import multiprocessing as mp
 import os
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from itertools import groupby
 
 import SimpleITK as sitk
 import numpy as np
 import radiomics
-from radiomics import featureextractor
-from filelock import FileLock
+from tqdm import tqdm
 
-from scipy import ndimage
-from random import randint
+from corad import filter_cache as fc
+from corad import profiling
+from corad import scheduling as sch
+from corad import volume_cache as vc
+from corad.utilities import sampled_mask_name
+from radiomics import featureextractor
 
 '''
     This file contains functions which interact with the Pyradiomics library.
@@ -20,6 +28,13 @@ from random import randint
 HI_VERBOSITY = 10
 LO_VERBOSITY = 40
 
+# Side of the square window used to sample the masks, and the number of slices searched for windows at once
+WINDOW = 20
+SLICE_BATCH = 32
+
+# State of a pool worker, the extractor is built once per worker by init_worker instead of being pickled per task
+_worker_state = {}
+
 
 def setup_logger(log_path):
     radiomics.setVerbosity(LO_VERBOSITY)
@@ -35,38 +50,70 @@ def setup_logger(log_path):
     return logger
 
 
-def ROI_sampling(mask: sitk.Image) -> sitk.Image:
+def _window_sums(chunk: np.ndarray) -> np.ndarray:
+    """ Sums every WINDOW x WINDOW square of a stack of slices, using an integral image over the stack"""
+    depth, height, width = chunk.shape
+    integral = np.zeros((depth, height + 1, width + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(chunk, axis=1, dtype=np.int64), axis=2, out=integral[:, 1:, 1:])
+    # The sum of any window follows from the four corners of the integral image
+    return (integral[:, WINDOW:, WINDOW:] - integral[:, :-WINDOW, WINDOW:]
+            - integral[:, WINDOW:, :-WINDOW] + integral[:, :-WINDOW, :-WINDOW])
+
+
+def sample_windows(mask_arr: np.ndarray, seed=None) -> np.ndarray:
+    """
+    Picks one WINDOW x WINDOW square per slice and per label of a (z, y, x) mask array, at a random position where the
+    square lies entirely within that label. Returns an array which only keeps the mask values inside the chosen
+    squares. The seed may be anything accepted by numpy.random.default_rng, a fixed seed makes the sampling
+    reproducible.
+    """
+    rng = np.random.default_rng(seed)
+    depth, height, width = mask_arr.shape
+    out_arr = np.zeros_like(mask_arr)
+    if height < WINDOW or width < WINDOW:
+        return out_arr
+
+    corners_y, corners_x = height - WINDOW + 1, width - WINDOW + 1
+    area = WINDOW * WINDOW
+    chosen = []
+    for start in range(0, depth, SLICE_BATCH):
+        chunk = mask_arr[start:start + SLICE_BATCH].astype(np.int64)
+        # A window lies within a single label when all of its values equal its corner value, which holds exactly when
+        # the sums of the values and of their squares match those of a constant window. One pass covers all labels.
+        corner = chunk[:, :corners_y, :corners_x]
+        valid = ((corner != 0) & (_window_sums(chunk) == area * corner)
+                 & (_window_sums(chunk * chunk) == area * corner * corner))
+        corner = corner.reshape(chunk.shape[0], -1)
+        valid = valid.reshape(chunk.shape[0], -1)
+
+        for lvl in np.unique(corner[valid]):
+            valid_lvl = valid & (corner == lvl)
+            # Draw the n-th valid position of every slice which has one
+            counts = valid_lvl.sum(axis=1)
+            slices = np.flatnonzero(counts)
+            picks = rng.integers(0, counts[slices])
+            positions = (np.cumsum(valid_lvl[slices], axis=1, dtype=np.int32) > picks[:, None]).argmax(axis=1)
+            chosen.append((slices + start, positions // corners_x, positions % corners_x))
+
+    if chosen:
+        # Copy all chosen windows into the output in a single write, windows of different labels never overlap
+        z, y, x = (np.concatenate(parts) for parts in zip(*chosen))
+        offsets = np.arange(WINDOW)
+        zz = z[:, None, None]
+        yy = y[:, None, None] + offsets[None, :, None]
+        xx = x[:, None, None] + offsets[None, None, :]
+        out_arr[zz, yy, xx] = mask_arr[zz, yy, xx]
+    return out_arr
+
+
+def ROI_sampling(mask: sitk.Image, seed=None) -> sitk.Image:
     """
     Clips the default mask using a standard area, overcoming the area dependence of certain first order measures such as
     Shannon entropy.
     """
     # The original type is float64, we convert to int32
-    discretized_mask = sitk.Cast(mask, sitk.sitkUInt32)
-    output = sitk.Image(mask.GetSize(), sitk.sitkUInt32)
-
-    # For each slice in the mask we try to find a suitable region
-    for z in np.arange(discretized_mask.GetDepth()):
-        # Extract a slice from the mask
-        img = discretized_mask[:, :, z.item()]
-        img_arr = sitk.GetArrayFromImage(img)
-
-        # Erode the mask using a 20 x 20 box
-        img_arr_eroded = ndimage.binary_erosion(img_arr, structure=np.ones((20, 20)))
-        out_arr = sitk.GetArrayFromImage(output[:, :, z.item()])
-
-        # Pick a random location within the eroded mask, this will be the new center of our window
-        indices = np.nonzero(img_arr_eroded)
-        # Check if there are any indices in the tuple
-        if len(indices[0]):
-            random_index = randint(0, len(indices[0]) - 1)
-            # Create a new image of the intersect of the mask with the selected window
-            c_x = indices[0][random_index]
-            c_y = indices[1][random_index]
-
-            out_arr[c_x - 10:c_x + 10, c_y - 10:c_y + 10] = img_arr[c_x - 10:c_x + 10, c_y - 10:c_y + 10]
-        # Paste the new image into the output image
-        img_vol = sitk.JoinSeries(sitk.GetImageFromArray(out_arr))
-        output = sitk.Paste(output, img_vol, img_vol.GetSize(), destinationIndex=[0, 0, z.item()])
+    mask_arr = sitk.GetArrayFromImage(sitk.Cast(mask, sitk.sitkUInt32))
+    output = sitk.GetImageFromArray(sample_windows(mask_arr, seed))
     output.CopyInformation(mask)
     return output
 
@@ -84,10 +131,102 @@ def initialize_extractor(parameters: str, logger: radiomics.logger) -> featureex
     return extractor
 
 
-def extract_features(files: list, extractor: radiomics.featureextractor.RadiomicsFeatureExtractor, output_csv,
-                      lab_val: int = 1, logger: radiomics.logger = None):
+def group_cases(file_list: list) -> list:
     """
-    Reads a tuple of file and mask, extracts features
+    Groups the rows of a case file by their (Image, Mask) pair, so every pair only has to be loaded once. The order of
+    first appearance is kept. Returns a list of (image, mask, labels) tuples.
+    """
+    groups = OrderedDict()
+    for image, mask, label in file_list:
+        groups.setdefault((image, mask), []).append(label)
+    return [(image, mask, labels) for (image, mask), labels in groups.items()]
+
+
+def iter_groups(cases):
+    """
+    Streams the groups of consecutive rows sharing an (image, mask) pair as (image, mask, labels) tuples. Unlike
+    group_cases this holds one group in memory at a time, rows of a pair which are not next to each other end up in
+    separate groups.
+    """
+    for (image, mask), rows in groupby(cases, key=lambda row: (row[0], row[1])):
+        yield image, mask, [label for _, _, label in rows]
+
+
+def resolve_label(label, lab_val: int) -> int:
+    """ Returns the label to extract, a label defined in the input file takes precedence over the argument"""
+    if not label:
+        return lab_val
+    try:
+        return int(label)
+    except ValueError:
+        raise ValueError('Label {} is not a number'.format(label))
+
+
+def read_volumes(image, mask) -> tuple:
+    """ Reads an image/mask pair as sitk images, through the volume cache when it is enabled"""
+    return vc.read_image(image), vc.read_image(mask)
+
+
+def group_signatures(group: tuple, caches: dict):
+    """ Signatures of the image and mask of a group, all caches of a run identify files the same way"""
+    return next(iter(caches.values())).signatures(group[0], group[1])
+
+
+def fully_cached(group: tuple, caches: dict, lab_val: int, signatures=None) -> bool:
+    """ Whether all labels of a group are in the result caches of all configurations, so it doesn't have to be read"""
+    labels = group[2]
+    if signatures is None:
+        signatures = group_signatures(group, caches)
+    try:
+        return all(cache.get(cache.key(signatures, resolve_label(label, lab_val))) is not None
+                   for cache in caches.values() for label in labels)
+    except ValueError:
+        # The invalid label is reported when the group is extracted
+        return False
+
+
+def prefetch_volumes(tasks, depth: int, max_bytes: int, skip=None):
+    """
+    Yields (index, group, volumes) for a stream of (index, group) tasks, where volumes is a future reading the
+    image/mask pair of the group in a background thread. Up to depth pairs are read ahead of the one being extracted,
+    as long as their size estimated from the headers stays within max_bytes, so reads overlap with extraction. Groups
+    for which skip(index, group) returns True are not read, their volumes are None.
+    """
+    tasks = iter(tasks)
+    pending = deque()
+    ahead = 0
+    with ThreadPoolExecutor(depth) as readers:
+        while True:
+            # Always read the next pair, pairs after it only while the memory cap is not reached
+            while len(pending) <= depth and (not pending or ahead < max_bytes):
+                task = next(tasks, None)
+                if task is None:
+                    break
+                index, group = task
+                if skip is not None and skip(index, group):
+                    pending.append((index, group, None, 0))
+                    continue
+                n_bytes = sch.volume_bytes(group[0]) + sch.volume_bytes(group[1])
+                pending.append((index, group, readers.submit(read_volumes, group[0], group[1]), n_bytes))
+                ahead += n_bytes
+            if not pending:
+                return
+            index, group, volumes, n_bytes = pending.popleft()
+            ahead -= n_bytes
+            yield index, group, volumes
+
+
+def extract_features(files: tuple, extractors: OrderedDict, result_queue, lab_val: int = 1,
+                     logger: radiomics.logger = None, profiler: profiling.CaseProfiler = None, index: int = None,
+                     caches: dict = None, volumes=None, signatures=None) -> list:
+    """
+    Reads a group of image, mask and labels, loads the image and mask once and extracts features for every label with
+    every extractor, given as a dict of configuration name to extractor. The rows of the group are put on the result
+    queue of the writer process as one (index, rows) message, the index is the position of the group in the run so the
+    writer can keep the original order. Labels found in the result cache of a configuration are not extracted again.
+    If volumes is given, the pair is taken from this future instead of being read here. The file signatures identifying
+    the pair in the caches are computed once per group, unless they are given, and the cache key is sent with every
+    row. If a profiler is given, the time and memory of every stage are recorded in it. Returns the rows of the group.
     """
 
     # Do this to handle parallel processing where we can't pass the logger
@@ -96,59 +235,263 @@ def extract_features(files: list, extractor: radiomics.featureextractor.Radiomic
     else:
         info = logger.info
         warning = logger.warning
+    stage = profiler.stage if profiler else profiling.no_stage
+    activate = profiler.activate if profiler else profiling.no_stage
 
-    image, mask, label = files
-    # TODO Efficiently extract for all labels in mask
-    if label:
-        # Label defined in the input file takes precedence over the argument
-        info('Overriding manual label (-b) parameter, was ' + str(lab_val) + ', now ' + label)
-        lab_val = int(label)
-    try:
-        result = extractor.execute(image, mask, label=lab_val)
-        # write to file
+    image, mask, labels = files
+    # One row per configuration and label, in that order
+    slots = [(config, label) for config in extractors for label in labels]
+    rows = [None] * len(slots)
+    keys = [None] * len(slots)
+    if caches:
+        if signatures is None:
+            signatures = group_signatures(files, caches)
+        for i, (config, label) in enumerate(slots):
+            cache = caches[config]
+            try:
+                keys[i] = cache.key(signatures, resolve_label(label, lab_val))
+            except ValueError:
+                continue
+            features = cache.get(keys[i])
+            if features is not None:
+                # A label of None tells the writer that this row does not have to be cached again
+                rows[i] = (image, mask, None, features, config, None)
+
+    if any(row is None for row in rows):
+        try:
+            # Load the pair once, pyradiomics accepts the in-memory images in place of file paths
+            with stage('read'):
+                image_vol, mask_vol = volumes.result() if volumes else read_volumes(image, mask)
+        except RuntimeError as err:
+            warning("Unable to read image or mask, error: {}".format(err))
+            image_vol = mask_vol = None
 
-    except ValueError as err:
-        warning("Unable to extract features, error: {}".format(err))
-        return None
+        # Filtered images are shared by all labels and masks of this image, when the filter cache is enabled
+        with fc.image(image):
+            for i, (config, label) in enumerate(slots):
+                if rows[i] is not None or image_vol is None:
+                    continue
+                try:
+                    label_value = resolve_label(label, lab_val)
+                    if label:
+                        info('Overriding manual label (-b) parameter, was ' + str(lab_val) + ', now ' + str(label))
+                    if profiler:
+                        profiler.label = label_value
+                    with activate(), stage('extract'):
+                        features = extractors[config].execute(image_vol, mask_vol, label=label_value)
+                    rows[i] = (image, mask, label_value, features, config, keys[i])
+                except ValueError as err:
+                    warning("Unable to extract features, error: {}".format(err))
 
-    store_row(image, mask, result, output_csv, logger)
-    # info('Extraction successful: \t' + image + '\t' + mask)
-    return result
+    # Hand the rows to the writer process, also when there are none so the writer does not wait for this group
+    rows = [row for row in rows if row is not None]
+    with stage('emit'):
+        result_queue.put((index, rows))
+    return rows
 
 
-def store_row(img, msk, features, out_path, logger):
-    # Store the calculated features in a csv file in default pyradiomics batch output style
-    if not features:
-        logger.warning('Can\'t store output, no features to store, continuing')
-        return
+def initialize_extractors(configs: dict, logger: radiomics.logger) -> OrderedDict:
+    """ Builds an extractor for every parameter file in a dict of configuration name to parameter file"""
+    return OrderedDict((config, initialize_extractor(parameters, logger)) for config, parameters in configs.items())
+
+
+def same_columns(extractors: OrderedDict) -> bool:
+    """ Whether all extractors enable the same image types and features, so their rows have the same columns"""
+    enabled = {json.dumps([extractor.enabledImagetypes, extractor.enabledFeatures], sort_keys=True, default=str)
+               for extractor in extractors.values()}
+    return len(enabled) <= 1
+
+
+def init_worker(configs: dict, result_queue, lab_val: int, profile: bool = False, caches: dict = None,
+                filter_cache_size: int = 0):
+    """ Pool initializer, builds the extractors once for the lifetime of the worker process"""
+    _worker_state['extractors'] = initialize_extractors(configs, radiomics.logger)
+    _worker_state['result_queue'] = result_queue
+    _worker_state['lab_val'] = lab_val
+    _worker_state['profile'] = profile
+    _worker_state['caches'] = caches
+    fc.enable(filter_cache_size)
+    if profile:
+        profiling.install_hooks()
+
+
+def iter_bundles(tasks):
+    """
+    Streams lists of consecutive (index, group) tasks sharing an image. A bundle is extracted by one process, so the
+    filtered images of its image are computed once for all its masks.
+    """
+    for _, bundle in groupby(tasks, key=lambda task: task[1][0]):
+        yield list(bundle)
+
+
+def extract_worker(bundle: list) -> tuple:
+    """
+    Extracts a bundle of (index, group) tasks using the extractors of this worker. Only the number of groups, the number
+    of rows written, how many of them came from the result cache and the profile records are sent back, the features
+    themselves go to the writer process.
+    """
+    n_written = n_cached = 0
+    records = []
+    for index, files in bundle:
+        profiler = profiling.CaseProfiler(files[0], files[1]) if _worker_state['profile'] else None
+        rows = extract_features(files, _worker_state['extractors'], _worker_state['result_queue'],
+                                _worker_state['lab_val'], profiler=profiler, index=index,
+                                caches=_worker_state['caches'])
+        n_written += len(rows)
+        n_cached += count_cached(rows)
+        if profiler:
+            records += profiler.records
+    return len(bundle), n_written, n_cached, records
+
+
+def give_up(bundle: list, result_queue) -> tuple:
+    """ Sends the groups of a bundle to the writer without rows, so the groups after them are still written"""
+    for index, _ in bundle:
+        result_queue.put((index, []))
+    return len(bundle), 0, 0, []
+
+
+def pool_results(bundles, workers: int, initargs: tuple, result_queue, max_memory: int = None):
+    """
+    Extracts bundles on a pool of workers, yielding the results of extract_worker as they finish. With max_memory,
+    bundles are only started while their memory estimated from the image headers fits in the budget, a bundle larger
+    than the budget runs on its own. When a worker dies, e.g. killed by the kernel for running out of memory, the
+    unfinished bundles are retried on a new pool with half the workers. A bundle which still kills a single worker is
+    given up, its groups are sent to the writer without rows so the groups after it are still written. The same happens
+    to a bundle which fails with an error, the other bundles go on. A stream which has nothing to extract yet, e.g. a
+    watched inbox, yields an empty bundle, finished bundles are then collected without waiting for them.
+    """
+    bundles = iter(bundles)
+    retry = deque()
+    broken = False
+    while True:
+        # Queue a bundle ahead per worker, unless its memory would count against the budget before it starts, or a
+        # worker died before and the bundle killing it has to be told apart from the others
+        limit = workers if max_memory or broken else 2 * workers
+        budget = max_memory - workers * sch.WORKER_BYTES if max_memory else None
+        executor = ProcessPoolExecutor(workers, mp.get_context(), init_worker, initargs)
+        # Start every worker right away, so the extractors are built before the first bundle arrives
+        for _ in range(workers):
+            executor.submit(int)
+        # Future -> (bundle, estimated memory)
+        running = {}
+        in_use = 0
+        held = None
+        lost = []
+        try:
+            while True:
+                idle = False
+                while len(running) < limit:
+                    if held is None:
+                        bundle = retry.popleft() if retry else next(bundles, None)
+                        if not bundle:
+                            idle = bundle is not None
+                            break
+                        held = (bundle, sch.bundle_memory(bundle) if budget is not None else 0)
+                    if running and budget is not None and in_use + held[1] > budget:
+                        break
+                    running[executor.submit(extract_worker, held[0])] = held
+                    in_use += held[1]
+                    held = None
+                if not running:
+                    if idle:
+                        continue
+                    return
+                done, _ = wait(running, timeout=0 if idle else None, return_when=FIRST_COMPLETED)
+                for future in done:
+                    bundle, memory = running.pop(future)
+                    in_use -= memory
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        lost.append(bundle)
+                        continue
+                    except Exception as err:
+                        print("Unable to extract {}, error: {!r}".format(bundle[0][1][0], err))
+                        result = give_up(bundle, result_queue)
+                    yield result
+                if lost:
+                    break
+        finally:
+            executor.shutdown(wait=not lost)
+
+        # Every bundle on the broken pool is lost with it, they are retried in dispatch order before the others
+        lost += [bundle for bundle, _ in running.values()]
+        if held is not None:
+            lost.append(held[0])
+        if workers == 1 and broken and len(lost) == 1:
+            bundle = lost.pop()
+            print("Worker died extracting {}, giving up on {} cases".format(bundle[0][1][0], len(bundle)))
+            yield give_up(bundle, result_queue)
+        else:
+            workers = max(1, workers // 2)
+            print("A worker died, retrying {} bundles with {} workers".format(len(lost), workers))
+        retry.extendleft(reversed(lost))
+        broken = True
+
+
+def count_cached(rows: list) -> int:
+    """ Rows taken from the result cache have no label, as they don't have to be cached again"""
+    return sum(1 for row in rows if row[2] is None)
+
+
+def labels_present(mask_arr: np.ndarray) -> np.ndarray:
+    """ Returns the nonzero labels occurring in a mask array"""
+    if mask_arr.size and mask_arr.min() >= 0 and mask_arr.max() < 1 << 16:
+        # Counting is a single pass, much cheaper than the sort done by np.unique
+        labels = np.flatnonzero(np.bincount(mask_arr.ravel()))
+    else:
+        labels = np.unique(mask_arr)
+    return labels[labels != 0]
+
+
+def sample_mask(mask_name, seed=None, combined: bool = False) -> list:
+    """
+    Samples all labels of a single mask file in one pass. Writes either one sampled mask per label, or a single
+    compressed mask holding the windows of all labels. Returns the names of the written files.
+    """
+    mask_arr, info = vc.read_array(mask_name)
+    if not np.issubdtype(mask_arr.dtype, np.integer):
+        # Integer masks are sampled as they are, possibly memory-mapped from the volume cache
+        mask_arr = mask_arr.astype(np.uint32)
+    sampled_arr = sample_windows(mask_arr, seed)
+
+    # Sampled masks are written as uint32, whatever the type of the mask
+    if combined:
+        out_name = sampled_mask_name(mask_name)
+        sitk.WriteImage(vc.to_image(sampled_arr.astype(np.uint32, copy=False), info), out_name, True)
+        return [out_name]
+
+    written = []
+    for lvl in labels_present(mask_arr):
+        out_img = vc.to_image(np.where(sampled_arr == lvl, np.uint32(lvl), np.uint32(0)), info)
+        out_name = sampled_mask_name(mask_name, lvl)
+        sitk.WriteImage(out_img, out_name)
+        written.append(out_name)
+    return written
+
+
+def _sample_mask_task(args: tuple) -> list:
+    mask_name, seed, combined = args
     try:
-        with FileLock(out_path + '.lock'):
-            out_file = open(out_path, 'a')
-            csv_columns = ["Image", "Mask", *list(features.keys())]
-            writer = csv.DictWriter(out_file, fieldnames=csv_columns)
-            if os.path.getsize(os.path.join(os.getcwd(), out_path)) == 0:
-                # File is empty, we can write the header
-                writer.writeheader()
-            features['Image'] = img
-            features['Mask'] = msk
-            writer.writerow(features)
-            out_file.flush()
-    except ValueError as err:
-        print(err)
-
-
-def sample_masks(file_list):
-    for (_, mask_name, _) in file_list:
-        mask = sitk.Cast(sitk.ReadImage(mask_name), sitk.sitkInt32)
-
-        # Hardcoded the levels right now, these correspond to the labels within the masks
-        low = 1
-        high = 5
-        for lvl in np.arange(low, high + 1):
-            tmp_mask = sitk.GetArrayFromImage(mask)
-            tmp_mask[tmp_mask != lvl] = 0
-            tmp_mask_img = sitk.GetImageFromArray(tmp_mask)
-            tmp_mask_img.CopyInformation(mask)
-            updated_mask = ROI_sampling(tmp_mask_img)
-            mask_prefix, mask_extension = os.path.splitext(mask_name)
-            sitk.WriteImage(updated_mask, mask_prefix + "_sampled_" + str(lvl) + mask_extension)
\ No newline at end of file
+        return sample_mask(mask_name, seed, combined)
+    except RuntimeError as err:
+        print("Unable to sample mask {}, error: {}".format(mask_name, err))
+        return []
+
+
+def sample_masks(file_list, workers: int = 1, combined: bool = False, seed=None):
+    """
+    Samples every distinct mask in the file list, spread over a pool of worker processes. Every mask gets its own
+    random stream derived from the seed, so a fixed seed gives the same result regardless of scheduling.
+    """
+    mask_names = list(OrderedDict.fromkeys(mask_name for _, mask_name, _ in file_list))
+    seeds = np.random.SeedSequence(seed).spawn(len(mask_names))
+    tasks = [(mask_name, mask_seed, combined) for mask_name, mask_seed in zip(mask_names, seeds)]
+    if workers > 1:
+        with mp.Pool(min(workers, max(len(tasks), 1))) as pool:
+            for _ in tqdm(pool.imap_unordered(_sample_mask_task, tasks), total=len(tasks)):
+                pass
+    else:
+        for task in tqdm(tasks):
+            _sample_mask_task(task)
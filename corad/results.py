@@ -0,0 +1,129 @@
+import csv
+import os
+from array import array
+from collections import OrderedDict
+
+import numpy as np
+
+'''
+    This file contains the columnar result formats, a feature matrix in a .npz file or a Parquet table, the converter
+    from a results csv and the loader which returns the feature matrix of any of them.
+'''
+
+# Columns describing a case rather than a feature, they are kept as strings next to the feature matrix, together with
+# the pyradiomics diagnostics
+CASE_COLUMNS = ('Image', 'Mask', 'Config')
+DIAGNOSTICS_PREFIX = 'diagnostics_'
+# Separates the strings of the string table of a .npz file
+STRING_SEPARATOR = '\0'
+
+
+def is_feature(column) -> bool:
+    return column not in CASE_COLUMNS and not column.startswith(DIAGNOSTICS_PREFIX)
+
+
+def _to_float(value) -> float:
+    """ Empty values, e.g. of a feature missing in one configuration, and values which aren't numbers become NaN"""
+    try:
+        return float(value)
+    except ValueError:
+        return float('nan')
+
+
+def read_csv(in_path) -> tuple:
+    """
+    Parses a results csv into a float64 feature matrix with a row per case, the names of its columns, and a dict of the
+    string columns describing the cases, as object arrays. Values are collected in a flat array, so rows don't become
+    Python lists. Columns missing at the end of a short row are NaN, or empty strings for the case columns.
+    """
+    with open(in_path, newline='') as in_file:
+        reader = csv.reader(in_file)
+        header = next(reader, [])
+        feature_columns = [i for i, name in enumerate(header) if is_feature(name)]
+        case_columns = [i for i, name in enumerate(header) if not is_feature(name)]
+        values = array('d')
+        case_values = [[] for _ in case_columns]
+        n_rows = 0
+        for row in reader:
+            if len(row) < len(header):
+                # Older outputs have rows which end early, e.g. of a configuration with fewer features
+                row += [''] * (len(header) - len(row))
+            values.extend(_to_float(row[i]) for i in feature_columns)
+            for column, i in zip(case_values, case_columns):
+                column.append(row[i])
+            n_rows += 1
+    features = np.frombuffer(values, dtype=np.float64).reshape(n_rows, len(feature_columns))
+    cases = OrderedDict((header[i], np.array(column, dtype=object)) for i, column in zip(case_columns, case_values))
+    return features, [header[i] for i in feature_columns], cases
+
+
+def write_npz(out_path, features: np.ndarray, feature_names: list, cases: dict):
+    """
+    Stores the feature matrix with its column index, and the case columns as codes into a table of their distinct
+    strings. Most diagnostics are the same for every case, and numpy strings are padded to the longest one, so the
+    table is stored as one UTF-8 blob.
+    """
+    strings = []
+    codes = np.empty((features.shape[0], len(cases)), dtype=np.int32)
+    for i, column in enumerate(cases.values()):
+        distinct, codes[:, i] = np.unique(column.astype(str), return_inverse=True)
+        codes[:, i] += len(strings)
+        strings += distinct.tolist()
+    blob = np.frombuffer(STRING_SEPARATOR.join(strings).encode(), dtype=np.uint8)
+    # Not compressed, so loading is a plain read of the arrays
+    with open(out_path, 'wb') as out_file:
+        np.savez(out_file, features=features, feature_names=np.array(feature_names, dtype=str), cases=codes,
+                 case_columns=np.array(list(cases), dtype=str), strings=blob)
+
+
+def write_parquet(out_path, features: np.ndarray, feature_names: list, cases: dict):
+    """ Stores the case columns as strings followed by a float64 column per feature, requires pyarrow"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    columns = OrderedDict((name, pa.array(column.tolist(), pa.string())) for name, column in cases.items())
+    for i, name in enumerate(feature_names):
+        columns[name] = pa.array(features[:, i])
+    pq.write_table(pa.table(columns), out_path)
+
+
+def load_results(path) -> tuple:
+    """
+    Loads a results file as (features, feature_names, cases), a float64 matrix with a row per case, the names of its
+    columns and a dict of the string columns describing the cases. The format follows from the extension, .npz,
+    .parquet or otherwise csv.
+    """
+    extension = os.path.splitext(path)[1]
+    if extension == '.npz':
+        with np.load(path) as data:
+            strings = np.array(data['strings'].tobytes().decode().split(STRING_SEPARATOR), dtype=object)
+            codes = data['cases']
+            cases = OrderedDict((name, strings[codes[:, i]]) for i, name in enumerate(data['case_columns'].tolist()))
+            return data['features'], data['feature_names'].tolist(), cases
+    if extension == '.parquet':
+        import pyarrow.parquet as pq
+        table = pq.read_table(path)
+        feature_names = [name for name in table.column_names if is_feature(name)]
+        features = np.empty((table.num_rows, len(feature_names)))
+        for i, name in enumerate(feature_names):
+            features[:, i] = table.column(name).to_numpy()
+        cases = OrderedDict((name, np.array(table.column(name).to_pylist(), dtype=object))
+                            for name in table.column_names if not is_feature(name))
+        return features, feature_names, cases
+    return read_csv(path)
+
+
+def results_output(in_path, output_format: str) -> str:
+    """ Returns the file next to a results csv in another format, e.g. results.npz for results.csv"""
+    return '{}.{}'.format(os.path.splitext(in_path)[0], output_format)
+
+
+def convert_results(in_path, out_path, output_format: str) -> int:
+    """ Converts a results csv to the npz or parquet format, returns the number of rows"""
+    features, feature_names, cases = read_csv(in_path)
+    if output_format == 'npz':
+        write_npz(out_path, features, feature_names, cases)
+    elif output_format == 'parquet':
+        write_parquet(out_path, features, feature_names, cases)
+    else:
+        raise ValueError('Unknown output format {}'.format(output_format))
+    return features.shape[0]
@@ -0,0 +1,220 @@
+import heapq
+import json
+import os
+from array import array
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+'''
+    This file contains the cost estimates of cases, the largest first dispatch order and the partitioning of cases over
+    shards.
+'''
+
+# Number of threads reading image headers for the cost estimates
+HEADER_THREADS = 16
+# Number of groups whose costs are estimated and ordered together, bounding the memory of a streamed run
+DISPATCH_WINDOW = 4096
+# Pyradiomics keeps several float64 copies of a volume while preprocessing and filtering, this is the memory per
+# voxel of the image assumed for a case, on top of the memory of a worker process itself
+CASE_BYTES_PER_VOXEL = 48
+WORKER_BYTES = 300 * 1024 ** 2
+
+
+def _image_information(path):
+    """ Returns a reader holding the header of an image, or None if the header can't be read"""
+    # Imported here, so merging shard outputs doesn't load SimpleITK
+    import SimpleITK as sitk
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    try:
+        reader.ReadImageInformation()
+    except RuntimeError:
+        return None
+    return reader
+
+
+def image_voxels(path):
+    """ Reads the number of voxels of an image from its header only, returns None if the header can't be read"""
+    reader = _image_information(path)
+    if reader is None:
+        return None
+    voxels = 1
+    for size in reader.GetSize():
+        voxels *= size
+    return voxels
+
+
+def volume_bytes(path) -> int:
+    """ Estimates the memory of a decoded image from its header, 0 if the header can't be read"""
+    # Imported here, so merging shard outputs doesn't load SimpleITK
+    import SimpleITK as sitk
+    reader = _image_information(path)
+    if reader is None:
+        return 0
+    pixel_bytes = sitk.Image([1] * reader.GetDimension(), reader.GetPixelID()).GetSizeOfPixelComponent()
+    voxels = 1
+    for size in reader.GetSize():
+        voxels *= size
+    return voxels * reader.GetNumberOfComponents() * pixel_bytes
+
+
+def case_cost(group: tuple) -> float:
+    """
+    Estimates the cost of an image/mask group as the number of voxels in the image times the number of labels. Falls
+    back to the file sizes if the header can't be read, and to 1 if the files don't exist at all.
+    """
+    image, mask, labels = group
+    voxels = image_voxels(image)
+    if voxels is None:
+        try:
+            voxels = os.path.getsize(image) + os.path.getsize(mask)
+        except OSError:
+            voxels = 1
+    return float(voxels) * len(labels)
+
+
+def case_memory(group: tuple) -> int:
+    """ Estimates the peak memory of extracting an image/mask group from the image header"""
+    voxels = image_voxels(group[0]) or 0
+    return voxels * CASE_BYTES_PER_VOXEL
+
+
+def bundle_memory(bundle: list) -> int:
+    """ The groups of a bundle are extracted one after the other, so a bundle needs the memory of its largest group"""
+    return max(case_memory(group) for _, group in bundle)
+
+
+def load_timings(profile_path) -> dict:
+    """
+    Reads the seconds spent per image/mask pair from the .profile.jsonl file of a previous run, summing the stages which
+    make up a case. Returns an empty dict if there is no profile.
+    """
+    # Imported here, the stage names are the only thing needed from the profiler
+    from corad.profiling import CASE_STAGES
+    timings = defaultdict(float)
+    try:
+        with open(profile_path) as profile_file:
+            for line in profile_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('stage') in CASE_STAGES:
+                    timings[(record['image'], record['mask'])] += record['seconds']
+    except OSError:
+        pass
+    return dict(timings)
+
+
+def estimate_costs(case_groups: list, timings: dict = None) -> list:
+    """
+    Estimates the cost of every group from the image headers. Groups with a timing from a previous run get that timing
+    instead, and the header estimates of the others are scaled to seconds by the median seconds per voxel of the timed
+    groups, so both kinds of costs can be compared.
+    """
+    # Reading headers is mostly waiting on the disk, so they are read from a few threads
+    with ThreadPoolExecutor(HEADER_THREADS) as executor:
+        costs = list(executor.map(case_cost, case_groups))
+    if not timings:
+        return costs
+
+    rates = []
+    timed = []
+    for group, cost in zip(case_groups, costs):
+        seconds = timings.get((group[0], group[1]))
+        timed.append(seconds)
+        if seconds is not None and cost > 0:
+            rates.append(seconds / cost)
+    if not rates:
+        return costs
+    rate = sorted(rates)[len(rates) // 2]
+    return [seconds if seconds is not None else cost * rate for seconds, cost in zip(timed, costs)]
+
+
+def chunks(iterable, size: int):
+    """ Yields lists of up to size consecutive items"""
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def dispatch_order(bundles, timings: dict = None, window: int = DISPATCH_WINDOW):
+    """
+    Reorders a stream of bundles, lists of (index, group) tasks, by decreasing cost, so the largest cases start first
+    and the small ones fill up the workers at the end. Bundles are ordered per window of consecutive bundles, which
+    keeps memory bounded on large case files at the price of only ordering within a window.
+    """
+    for chunk in chunks(bundles, window):
+        group_costs = iter(estimate_costs([group for bundle in chunk for _, group in bundle], timings))
+        costs = [sum(next(group_costs) for _ in bundle) for bundle in chunk]
+        for i in sorted(range(len(chunk)), key=lambda i: (-costs[i], i)):
+            yield chunk[i]
+
+
+def shard_voxels(image) -> int:
+    """
+    Number of voxels of an image for the shard assignment, which every shard has to compute identically. A file which
+    doesn't exist counts as 1 voxel, a file whose header can't be read raises a RuntimeError, as another shard may read
+    it and would then divide the cases differently.
+    """
+    voxels = image_voxels(image)
+    if voxels is not None:
+        return voxels
+    if os.path.exists(image):
+        raise RuntimeError('Unable to read the header of {}, all shards have to read the same headers to divide the '
+                           'cases in the same way'.format(image))
+    return 1
+
+
+def shard_assignment(case_groups, n_shards: int) -> array:
+    """
+    Assigns every group to one of n_shards shards of about equal total cost. Groups are assigned per image, so all
+    masks of an image end up in one shard, where they share its filtered images. The cost of an image is its number of
+    voxels times the number of labels of all its groups, the most expensive images go first to the least loaded
+    shard. The assignment only depends on the case file and the image headers, so every shard computes the same one.
+    Groups are streamed, only their images, costs and shard numbers are kept.
+    """
+    image_ids = {}
+    labels = array('d')
+    group_images = array('i')
+    for image, _, group_labels in case_groups:
+        image_id = image_ids.setdefault(image, len(image_ids))
+        if image_id == len(labels):
+            labels.append(0)
+        labels[image_id] += len(group_labels)
+        group_images.append(image_id)
+    # Reading headers is mostly waiting on the disk, so they are read from a few threads
+    with ThreadPoolExecutor(HEADER_THREADS) as executor:
+        costs = [voxels * n_labels for voxels, n_labels in zip(executor.map(shard_voxels, image_ids), labels)]
+
+    loads = [(0.0, shard) for shard in range(n_shards)]
+    image_shards = array('i', [0]) * len(costs)
+    for image_id in sorted(range(len(costs)), key=lambda i: (-costs[i], i)):
+        load, shard = heapq.heappop(loads)
+        image_shards[image_id] = shard
+        heapq.heappush(loads, (load + costs[image_id], shard))
+    return array('i', (image_shards[image_id] for image_id in group_images))
+
+
+def select_shard(case_groups, assignment: array, shard: int):
+    """ Streams the groups assigned to a shard, counting shards from 0, in their original order"""
+    for group, assigned in zip(case_groups, assignment):
+        if assigned == shard:
+            yield group
+
+
+def parse_shard(value: str) -> tuple:
+    """ Parses a shard given as i/N, with i counting from 1 to N"""
+    index, count = (int(part) for part in value.split('/'))
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError('Shard {} is not within 1/N to N/N'.format(value))
+    return index, count
+
+
+def shard_output(out_path, index: int, count: int) -> str:
+    """ Returns the result file of a shard, e.g. results.shard-2-of-8.csv for results.csv"""
+    root, extension = os.path.splitext(out_path)
+    return '{}.shard-{}-of-{}{}'.format(root, index, count, extension)
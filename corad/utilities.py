@@ -1,11 +1,19 @@
+import bz2
 import csv
+import glob
+import gzip
+import lzma
 import os
-from lungmask import mask
+import multiprocessing as mp
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby, islice
 from pathlib import Path
-import SimpleITK as sitk
+from tqdm import tqdm
 
 '''
-    This file contains simple utility functions.
+    This file contains simple utility functions. numpy, SimpleITK and the volume cache are imported by the functions
+    using them, so commands like cora cases start without them.
     Frank te Nijenhuis 2020
 '''
 
@@ -17,24 +25,90 @@ def print_features(features_list) -> None:
             print("Computed %s: %s" % (featureName, features[featureName]))
 
 
+# Openers of compressed case files by extension, anything else is read as plain text
+MANIFEST_OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+MANIFEST_PATTERNS = ('*.csv', '*.csv.gz', '*.csv.bz2', '*.csv.xz')
+# Number of threads checking that the files of a case file exist, and how far they may run ahead
+STAT_THREADS = 32
+STAT_WINDOW = 1024
+# Extensions of the files cora convert accepts
+NIFTI_EXTENSIONS = ('.nii.gz', '.nii')
+
+
+def manifest_paths(source) -> list:
+    """ Expands a case file argument, which can be a file, a directory of case files or a glob pattern"""
+    if os.path.isdir(source):
+        return sorted(path for pattern in MANIFEST_PATTERNS for path in glob.glob(os.path.join(source, pattern)))
+    if glob.has_magic(source):
+        return sorted(glob.glob(source))
+    return [source]
+
+
+def open_manifest(file_path):
+    opener = MANIFEST_OPENERS.get(os.path.splitext(file_path)[1], open)
+    return opener(file_path, 'rt', newline='')
+
+
+def iter_cases(source, logger):
+    """
+    Streams the (image, mask, label) rows of one or more case files, see manifest_paths, which may be compressed. The
+    label column is optional, rows without one get an empty label. Only one row is held in memory at a time.
+    """
+    for file_path in manifest_paths(source):
+        try:
+            with open_manifest(file_path) as csvfile:
+                logger.info('Attempting to open: ' + file_path + ' to read as input')
+                reader = csv.reader(csvfile, quotechar='|')
+                # Skips the header in the file
+                next(reader, None)
+                for row in reader:
+                    if len(row) < 2:
+                        continue
+                    yield row[0], row[1], row[2] if len(row) > 2 else ''
+        except IOError:
+            logger.error('Unable to read file {}'.format(file_path), exc_info=True)
+    logger.info('Input files loaded')
+
+
 def read_files(file_path, logger):
     """ Reads a csv file containing pairs of scan names and masks, returns a list of masks """
-    try:
-        with open(file_path, newline='') as csvfile:
-            logger.info('Attempting to open: ' + file_path + ' to read as input')
-            reader = csv.reader(csvfile, quotechar='|')
-            # Skips the header in the file
-            next(reader)
-            path_list = []
-            for row in reader:
-                data_path = row[0]
-                mask_path = row[1]
-                label = row[2]
-                path_list.append((data_path, mask_path, label))
-    except IOError:
-        logger.error('Unable to read file {}'.format(file_path), exc_info=True)
-    logger.info('Input files loaded')
-    return path_list
+    return list(iter_cases(file_path, logger))
+
+
+def threaded_map(func, iterable, threads: int, window: int):
+    """
+    Like map, but runs func in a pool of threads. Unlike Executor.map the input is consumed lazily, at most window items
+    are in flight, so it can be used on streams of any length.
+    """
+    with ThreadPoolExecutor(threads) as executor:
+        pending = deque(executor.submit(func, item) for item in islice(iterable, window))
+        for item in iterable:
+            yield pending.popleft().result()
+            pending.append(executor.submit(func, item))
+        while pending:
+            yield pending.popleft().result()
+
+
+def _missing_files(pair) -> list:
+    return [path for path in pair if not os.path.isfile(path)]
+
+
+def validate_cases(source, logger) -> tuple:
+    """
+    Checks that the images and masks of all rows exist, stat calls are issued from a pool of threads since on network
+    storage they are mostly waiting. Consecutive rows sharing an image and mask are one case, and are checked once.
+    Returns the number of cases and the list of missing files, which are also logged.
+    """
+    pairs = (pair for pair, _ in groupby(iter_cases(source, logger), key=lambda row: row[:2]))
+    n_cases = 0
+    missing = []
+    for missing_files in threaded_map(_missing_files, pairs, STAT_THREADS, STAT_WINDOW):
+        n_cases += 1
+        for path in missing_files:
+            if not missing or path != missing[-1]:
+                logger.warning('Missing input file {}'.format(path))
+                missing.append(path)
+    return n_cases, missing
 
 
 def store_features(features, file_names, out_path, logger):
@@ -120,19 +194,21 @@ def write_UMCG(writer, sampled: bool, denoised: bool = False):
         for file in os.listdir(parent):
             if file.endswith('.nii') or file.endswith('.gz'):
                 pair['Image'] = (os.path.join(parent, file))
+                mask_path = [m for m in os.listdir(mask_dir)
+                             if m.endswith(folder + '.dcm.nii') or m.endswith(folder + '.dcm.nii.gz')]
+                if not mask_path:
+                    continue
+                mask_path = os.path.join(mask_dir, mask_path[0])
                 if not sampled:
-                    mask_path = [m for m in os.listdir(mask_dir) if m.endswith(folder + '.dcm.nii')]
-                    if mask_path:
-                        pair['Mask'] = os.path.join(mask_dir, mask_path[0])
-                        # Write for the different labels
-                        for i in range(1, 6):
-                            pair['Label'] = i
-                            writer.writerow(pair)
+                    pair['Mask'] = mask_path
+                    # Write for the different labels
+                    for i in range(1, 6):
+                        pair['Label'] = i
+                        writer.writerow(pair)
                 else:
-                    # sampled version
+                    # sampled version, named after the mask the samples were taken from, as cora sample does
                     for i in range(1, 6):
-                        mask_path = folder + ".dcm_sampled_" + str(i) + ".nii"
-                        pair['Mask'] = os.path.join(mask_dir, mask_path)
+                        pair['Mask'] = sampled_mask_name(mask_path, i)
                         pair['Label'] = i
                         writer.writerow(pair)
 
@@ -141,36 +217,210 @@ def write_UMCG_D(writer, sampled):
     write_UMCG(writer, sampled, True)
 
 
-def convert_nifti_to_png(file_list):
-    if all(file[0].endswith('.nii') and file[1].endswith('.nii') for file in file_list):
-        for file in file_list:
-            cmd = 'med2image -i ' + file[0] + ' -d ' + file[0].split('.')[0] + ' -t png'
-            os.system(cmd)
-            cmd = 'med2image -i ' + file[1] + ' -d ' + file[1].split('.')[0] + '_msk' + ' -t png'
-            os.system(cmd)
+def sampled_mask_name(mask_name, lvl=None) -> str:
+    """ Returns the file name of a sampled mask, either for a single label or for the combined multi-label mask"""
+    if mask_name.endswith('.nii.gz'):
+        mask_prefix, mask_extension = mask_name[:-len('.nii.gz')], '.nii.gz'
+    else:
+        mask_prefix, mask_extension = os.path.splitext(mask_name)
+    if lvl is not None:
+        return mask_prefix + "_sampled_" + str(lvl) + mask_extension
+    return mask_prefix + "_sampled.nii.gz"
+
+
+def strip_nifti_extension(path) -> str:
+    """ Removes a .nii or .nii.gz extension from a path"""
+    for extension in NIFTI_EXTENSIONS:
+        if path.endswith(extension):
+            return path[:-len(extension)]
+    return os.path.splitext(path)[0]
+
+
+def intensity_window(volume, center: float = None, width: float = None) -> tuple:
+    """
+    Returns the lowest and highest intensity of a window. With a window center and width (e.g. -600 and 1500 for lung
+    tissue in HU) these are its bounds, otherwise the minimum and maximum of the volume are used.
+    """
+    if center is None or width is None:
+        return float(volume.min()), float(volume.max())
+    return center - width / 2, center + width / 2
+
+
+def window_intensity(volume, center: float = None, width: float = None, window: tuple = None):
+    """
+    Maps the intensities of a volume to 8 bit grey values, everything outside the window is clipped. The window is
+    given as center and width, or as the (low, high) bounds returned by intensity_window.
+    """
+    import numpy as np
+    low, high = window or intensity_window(volume, center, width)
+    scale = 255 / (high - low) if high > low else 0
+    return ((np.clip(volume, low, high) - low) * scale).astype(np.uint8)
 
+
+def write_png_slices(volume, out_dir, slices, convert=None):
+    """
+    Writes the given axial slices of a (z, y, x) volume as png files. Every slice is converted to 8 bit by convert
+    while it is written, so the volume itself is never copied.
+    """
+    import SimpleITK as sitk
+    os.makedirs(out_dir, exist_ok=True)
+    for z in slices:
+        image_slice = convert(volume[z]) if convert else volume[z]
+        sitk.WriteImage(sitk.GetImageFromArray(image_slice), os.path.join(out_dir, 'slice-{:03d}.png'.format(z)))
+
+
+def convert_case(image_path, mask_path, center: float = None, width: float = None, skip_empty: bool = False) -> int:
+    """
+    Converts an image and its mask to png slices, loading each volume once. The image goes to a directory named after
+    the image file, the mask to the same name with _msk appended. Mask slices keep their label values. Returns the
+    number of slices written.
+    """
+    import numpy as np
+    from corad import volume_cache as vc
+    image_arr, _ = vc.read_array(image_path)
+    mask_arr, _ = vc.read_array(mask_path)
+    if skip_empty:
+        # Slices without any mask are useless as training input
+        slices = np.flatnonzero(mask_arr.reshape(mask_arr.shape[0], -1).any(axis=1))
     else:
+        slices = range(image_arr.shape[0])
+    window = intensity_window(image_arr, center, width)
+    write_png_slices(image_arr, strip_nifti_extension(image_path), slices,
+                     lambda image_slice: window_intensity(image_slice, window=window))
+    write_png_slices(mask_arr, strip_nifti_extension(mask_path) + '_msk', slices,
+                     lambda mask_slice: np.clip(mask_slice, 0, 255).astype(np.uint8))
+    return len(slices)
+
+
+def _convert_case_task(args: tuple) -> int:
+    try:
+        return convert_case(*args)
+    except RuntimeError as err:
+        print("Unable to convert {}, error: {}".format(args[0], err))
+        return 0
+
+
+def convert_nifti_to_png(file_list, workers: int = 1, center: float = None, width: float = None,
+                         skip_empty: bool = False):
+    """ Converts every distinct image and mask pair in the file list to png slices, using a pool of worker processes"""
+    pairs = list(OrderedDict.fromkeys((file[0], file[1]) for file in file_list))
+    if not all(f.endswith(NIFTI_EXTENSIONS) for pair in pairs for f in pair):
         print("Error, not all files in list are in nifti format")
+        return
+    tasks = [(image_path, mask_path, center, width, skip_empty) for image_path, mask_path in pairs]
+    if workers > 1:
+        with mp.Pool(min(workers, max(len(tasks), 1))) as pool:
+            written = sum(tqdm(pool.imap_unordered(_convert_case_task, tasks), total=len(tasks)))
+    else:
+        written = sum(_convert_case_task(task) for task in tqdm(tasks))
+    print("Slices written: {}".format(written))
 
 
-def create_masks(target):
-    dcm_dirs = []
+def find_series(target, out_dir) -> list:
+    """
+    Walks target for leaf directories, which always contain a dcm series. Returns (name, directory, mask path) tuples,
+    the name is the folder directly under target, which is what write_UMCG uses to pair images with masks.
+    """
+    series = []
+    names = set()
     for root, dirs, files in os.walk(target):
-        if not dirs:
-            # Walk until we are in a leaf directory, which always contains dcm series
-            p = Path(root)
-            name = p.parts[11]
-            dcm_dirs.append((name, root))
-    for name, cur_dir in dcm_dirs:
-        try:
-            reader = sitk.ImageSeriesReader()
-            dicom_names = reader.GetGDCMSeriesFileNames(cur_dir)
-            # print(dicom_names)
-            reader.SetFileNames(dicom_names)
-            input_image = reader.Execute()
-            segmentation = mask.apply_fused(input_image)
-            result_out = sitk.GetImageFromArray(segmentation)
-            result_out.CopyInformation(input_image)
-            sitk.WriteImage(result_out, name + '.dcm')
-        except Exception as err:
-            print(err)
+        if dirs or not files or os.path.abspath(root) == os.path.abspath(out_dir):
+            continue
+        parts = Path(os.path.relpath(root, target)).parts
+        name = parts[0] if parts and parts[0] != '.' else Path(root).name
+        # Several series in one folder get a numbered name, so they don't overwrite each other
+        unique_name, count = name, 1
+        while unique_name in names:
+            count += 1
+            unique_name = '{}_{}'.format(name, count)
+        names.add(unique_name)
+        series.append((unique_name, root, os.path.join(out_dir, unique_name + '.dcm.nii.gz')))
+    return series
+
+
+def mask_exists(mask_path) -> bool:
+    """ Checks for a compressed mask, or an uncompressed one written by an earlier version"""
+    return os.path.isfile(mask_path) or os.path.isfile(mask_path[:-len('.gz')])
+
+
+def read_series(cur_dir):
+    import SimpleITK as sitk
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(reader.GetGDCMSeriesFileNames(cur_dir))
+    return reader.Execute()
+
+
+def write_mask(segmentation, input_image, mask_path):
+    """ Writes a compressed mask, through a temporary file so an interrupted write is never mistaken for a mask"""
+    import SimpleITK as sitk
+    result_out = sitk.GetImageFromArray(segmentation)
+    result_out.CopyInformation(input_image)
+    tmp_path = mask_path[:-len('.nii.gz')] + '.partial.nii.gz'
+    sitk.WriteImage(result_out, tmp_path, True)
+    os.replace(tmp_path, mask_path)
+
+
+def mask_pipeline(series, threads: int = None, prefetch: int = 2):
+    """
+    Creates the masks for a list of series. Reader threads decode the next series while the current one is in inference
+    and a background thread writes the finished masks, so disk reads, inference and writes overlap.
+    """
+    # lungmask loads PyTorch, it is only imported when masks are actually created
+    import SimpleITK as sitk
+    from lungmask import mask
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+
+    todo = iter(series)
+    with ThreadPoolExecutor(prefetch) as readers, ThreadPoolExecutor(1) as writer:
+        pending = deque((item, readers.submit(read_series, item[1])) for item in islice(todo, prefetch))
+        writes = deque()
+        while pending:
+            (name, cur_dir, mask_path), loading = pending.popleft()
+            upcoming = next(todo, None)
+            if upcoming:
+                pending.append((upcoming, readers.submit(read_series, upcoming[1])))
+            try:
+                input_image = loading.result()
+                segmentation = mask.apply_fused(input_image)
+            except Exception as err:
+                print("Unable to create mask for {}, error: {}".format(cur_dir, err))
+                continue
+            writes.append((name, writer.submit(write_mask, segmentation, input_image, mask_path)))
+            # Collect finished writes, so their masks are released
+            while writes and writes[0][1].done():
+                _report_write(*writes.popleft())
+        while writes:
+            _report_write(*writes.popleft())
+
+
+def _report_write(name, future):
+    try:
+        future.result()
+    except Exception as err:
+        print("Unable to write mask {}, error: {}".format(name, err))
+
+
+def _mask_pipeline_task(args: tuple):
+    mask_pipeline(*args)
+
+
+def create_masks(target, out_dir=None, jobs: int = 1, threads: int = None, prefetch: int = 2):
+    """
+    Creates lung masks for all dcm series below target. Series whose mask already exists are skipped. With several jobs
+    the series are divided over that many processes, each running its own pipeline with threads inference threads.
+    """
+    if out_dir is None:
+        out_dir = os.path.join(target, 'Masks')
+    os.makedirs(out_dir, exist_ok=True)
+    series = [item for item in find_series(target, out_dir) if not mask_exists(item[2])]
+    print("Series to process: {}".format(len(series)))
+    if jobs > 1 and len(series) > 1:
+        # Spawn, so the inference libraries are initialized fresh in every process
+        parts = [(series[i::jobs], threads, prefetch) for i in range(min(jobs, len(series)))]
+        with mp.get_context('spawn').Pool(len(parts)) as pool:
+            pool.map(_mask_pipeline_task, parts)
+    else:
+        mask_pipeline(series, threads, prefetch)
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import SimpleITK as sitk
+
+'''
+    This file contains the opt-in cache of decoded volumes, stored as raw memory-mappable arrays.
+'''
+
+# The cache is configured through the environment, so pool workers pick it up without extra arguments
+CACHE_DIR_ENV = 'CORA_VOLUME_CACHE'
+CACHE_SIZE_ENV = 'CORA_VOLUME_CACHE_SIZE'
+DEFAULT_SIZE = 50 * 1024 ** 3
+
+
+def configure(cache_dir, max_bytes: int = DEFAULT_SIZE):
+    """ Enables the cache in cache_dir for this process and all processes started from it"""
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ[CACHE_DIR_ENV] = os.path.abspath(cache_dir)
+    os.environ[CACHE_SIZE_ENV] = str(int(max_bytes))
+
+
+def cache_dir():
+    return os.environ.get(CACHE_DIR_ENV)
+
+
+def _entry(path, directory):
+    """
+    Returns the base name of the cache entry of a file, which changes whenever the file does. Returns None if the file
+    can't be found, it is then read without the cache so the reader reports it like any other unreadable file.
+    """
+    if directory is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = '{}|{}|{}'.format(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    return os.path.join(directory, hashlib.sha1(key.encode()).hexdigest())
+
+
+def _image_info(image: sitk.Image) -> dict:
+    return {'spacing': image.GetSpacing(), 'origin': image.GetOrigin(), 'direction': image.GetDirection(),
+            'components': image.GetNumberOfComponentsPerPixel()}
+
+
+def to_image(arr: np.ndarray, info: dict) -> sitk.Image:
+    """
+    Builds a sitk image from an array and the geometry returned by read_array. SimpleITK images own their buffer, so
+    the array is copied, also when it is memory-mapped from the cache.
+    """
+    image = sitk.GetImageFromArray(arr, isVector=info['components'] > 1)
+    image.SetSpacing(info['spacing'])
+    image.SetOrigin(info['origin'])
+    image.SetDirection(info['direction'])
+    return image
+
+
+def _store(entry, arr: np.ndarray, info: dict):
+    """ Writes an entry through temporary files, so other processes never see a partial entry"""
+    directory = os.path.dirname(entry)
+    with tempfile.NamedTemporaryFile(dir=directory, suffix='.npy', delete=False) as tmp:
+        np.save(tmp, arr)
+    with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.json', delete=False) as tmp_info:
+        json.dump(info, tmp_info)
+    os.replace(tmp_info.name, entry + '.json')
+    os.replace(tmp.name, entry + '.npy')
+
+
+def evict(directory, max_bytes: int):
+    """ Removes the least recently used entries until the cache fits in max_bytes"""
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith('.npy'):
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name[:-len('.npy')]))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        for extension in ('.npy', '.json'):
+            try:
+                os.remove(os.path.join(directory, name + extension))
+            except FileNotFoundError:
+                pass
+        total -= size
+
+
+def read_array(path) -> tuple:
+    """
+    Reads a volume as a (z, y, x) array together with its geometry. With the cache enabled the decoded array is
+    memory-mapped from the cache, so processes reading the same volume share its pages through the OS page cache.
+    """
+    directory = cache_dir()
+    entry = _entry(path, directory)
+    if entry is None:
+        image = sitk.ReadImage(path)
+        return sitk.GetArrayFromImage(image), _image_info(image)
+
+    try:
+        with open(entry + '.json') as info_file:
+            info = json.load(info_file)
+        arr = np.load(entry + '.npy', mmap_mode='r')
+        # Touching the entry marks it as recently used for the eviction
+        os.utime(entry + '.npy')
+        return arr, info
+    except (OSError, ValueError):
+        pass
+
+    image = sitk.ReadImage(path)
+    arr, info = sitk.GetArrayFromImage(image), _image_info(image)
+    try:
+        _store(entry, arr, info)
+        evict(directory, int(os.environ.get(CACHE_SIZE_ENV, DEFAULT_SIZE)))
+    except OSError as err:
+        print("Unable to cache {}, error: {}".format(path, err))
+    return arr, info
+
+
+def read_image(path) -> sitk.Image:
+    """
+    Drop-in replacement for sitk.ReadImage which reads through the cache when it is enabled. A cached volume is not
+    decompressed again, but every process building an image from it gets its own copy, see to_image. A volume which
+    isn't cached yet is stored from the image as read, without converting it to an array and back.
+    """
+    directory = cache_dir()
+    entry = _entry(path, directory)
+    if entry is None:
+        return sitk.ReadImage(path)
+    if os.path.isfile(entry + '.npy'):
+        return to_image(*read_array(path))
+    image = sitk.ReadImage(path)
+    try:
+        _store(entry, sitk.GetArrayViewFromImage(image), _image_info(image))
+        evict(directory, int(os.environ.get(CACHE_SIZE_ENV, DEFAULT_SIZE)))
+    except OSError as err:
+        print("Unable to cache {}, error: {}".format(path, err))
+    return image
@@ -0,0 +1,111 @@
+import csv
+import os
+import time
+
+from corad.radiomics_funcs import iter_bundles, iter_groups
+
+'''
+    This file contains the sources of cora watch, an inbox directory or an append-only case file which are polled for
+    new image/mask pairs, and the stream of bundles fed to the warm worker pool.
+'''
+
+IMAGE_EXTENSIONS = ('.nii.gz', '.nii')
+# An image x.nii.gz in the inbox is paired with the mask x_mask.nii.gz
+MASK_SUFFIX = '_mask'
+# Files modified more recently than this may still be copied into the inbox, they are picked up by a later poll
+SETTLE_SECONDS = 2.0
+
+
+def written_cases(out_path) -> set:
+    """ Returns the (image, mask) pairs in an existing output, which a restarted watch doesn't extract again"""
+    if not os.path.isfile(out_path):
+        return set()
+    with open(out_path, newline='') as out_file:
+        return {(row['Image'], row['Mask']) for row in csv.DictReader(out_file)}
+
+
+def _split_extension(name) -> tuple:
+    for extension in IMAGE_EXTENSIONS:
+        if name.endswith(extension):
+            return name[:-len(extension)], extension
+    return name, None
+
+
+def new_inbox_cases(inbox, seen: set, settle: float = SETTLE_SECONDS) -> list:
+    """
+    Returns the (image, mask, label) rows of the complete image/mask pairs in inbox which are not in seen, and adds
+    them to it. Partial files, like the ones cora masks writes before renaming them, are skipped.
+    """
+    names = set(os.listdir(inbox))
+    now = time.time()
+    cases = []
+    for name in sorted(names):
+        stem, extension = _split_extension(name)
+        if extension is None or stem.endswith(MASK_SUFFIX) or '.partial' in stem:
+            continue
+        mask_name = next((stem + MASK_SUFFIX + ext for ext in IMAGE_EXTENSIONS if stem + MASK_SUFFIX + ext in names),
+                         None)
+        if mask_name is None:
+            continue
+        pair = (os.path.join(inbox, name), os.path.join(inbox, mask_name))
+        if pair in seen:
+            continue
+        try:
+            if now - max(os.path.getmtime(path) for path in pair) < settle:
+                continue
+        except OSError:
+            continue
+        seen.add(pair)
+        cases.append(pair + ('',))
+    return cases
+
+
+class ManifestTail:
+    """
+    Follows an append-only case file, returning the rows added since the previous read. The first line is the header,
+    a last line without a newline is still being written and is left for the next read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+
+    def read_new(self) -> list:
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return []
+        if size < self.offset:
+            # The case file was replaced or truncated, it is read from the start again
+            self.offset = 0
+        if size == self.offset:
+            return []
+        with open(self.path, 'rb') as case_file:
+            case_file.seek(self.offset)
+            data = case_file.read(size - self.offset)
+        end = data.rfind(b'\n') + 1
+        if not end:
+            return []
+        lines = data[:end].decode().splitlines()
+        if self.offset == 0:
+            lines = lines[1:]
+        self.offset += end
+        return [(row[0], row[1], row[2] if len(row) > 2 else '')
+                for row in csv.reader(lines, quotechar='|') if len(row) >= 2]
+
+
+def watch_bundles(poll, interval: float, stop):
+    """
+    Streams bundles of the new cases returned by poll, numbered on from the previous ones so the writer keeps them in
+    arrival order. When nothing is new it waits interval seconds and yields an empty bundle, so finished bundles are
+    collected in the meantime. Ends once the stop event is set.
+    """
+    index = 0
+    while not stop.is_set():
+        tasks = list(enumerate(iter_groups(poll()), index))
+        if not tasks:
+            stop.wait(interval)
+            yield []
+            continue
+        index += len(tasks)
+        yield from iter_bundles(tasks)
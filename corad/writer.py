@@ -0,0 +1,325 @@
+import csv
+import hashlib
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import signal
+import tempfile
+import time
+from collections import Counter, OrderedDict
+
+'''
+    This file contains the result writer, a single process which owns the output file.
+'''
+
+# Upper bound on the number of rows waiting for the writer, producers block when the writer falls behind
+QUEUE_SIZE = 1024
+
+# Rows held in memory while waiting for an earlier group, further groups are spilled to a temporary file
+REORDER_ROWS = 2048
+
+
+def read_header(out_path) -> list:
+    """ Returns the header of an existing output file, or an empty list if there is no output yet"""
+    if not os.path.isfile(out_path) or os.path.getsize(out_path) == 0:
+        return []
+    with open(out_path, newline='') as out_file:
+        return next(csv.reader(out_file), [])
+
+
+def written_rows(out_path) -> Counter:
+    """ Counts the rows per (image, mask, configuration) in an existing output file"""
+    if not os.path.isfile(out_path):
+        return Counter()
+    with open(out_path, newline='') as out_file:
+        return Counter((row['Image'], row['Mask'], row.get('Config') or None) for row in csv.DictReader(out_file))
+
+
+class ReorderBuffer:
+    """
+    Holds groups which arrive before their turn, keyed on their index. Up to max_rows rows are kept in memory, the
+    groups beyond that are pickled to a temporary file, so a slow early group can't make the writer grow unbounded.
+    """
+
+    def __init__(self, max_rows: int = REORDER_ROWS):
+        self.max_rows = max_rows
+        self._memory = {}
+        self._spilled = {}
+        self._n_rows = 0
+        self._spill_file = None
+
+    def __contains__(self, index):
+        return index in self._memory or index in self._spilled
+
+    def __len__(self):
+        return len(self._memory) + len(self._spilled)
+
+    def add(self, index: int, rows: list):
+        if self._n_rows + len(rows) <= self.max_rows:
+            self._memory[index] = rows
+            self._n_rows += len(rows)
+            return
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(prefix='cora_reorder_')
+        self._spill_file.seek(0, os.SEEK_END)
+        self._spilled[index] = self._spill_file.tell()
+        pickle.dump(rows, self._spill_file, pickle.HIGHEST_PROTOCOL)
+
+    def pop(self, index: int) -> list:
+        if index in self._memory:
+            rows = self._memory.pop(index)
+            self._n_rows -= len(rows)
+            return rows
+        self._spill_file.seek(self._spilled.pop(index))
+        return pickle.load(self._spill_file)
+
+    def pop_all(self):
+        """ Yields the remaining groups in index order"""
+        for index in sorted(list(self._memory) + list(self._spilled)):
+            yield self.pop(index)
+
+    def close(self):
+        if self._spill_file is not None:
+            self._spill_file.close()
+
+
+class ResultFile:
+    """
+    An output file kept open by the writer. The header is written with the first row, or taken from the existing file
+    we append to. Rows may miss columns. A row with columns outside the header, e.g. the diagnostics pyradiomics only
+    adds for resampled images or corrected masks, extends the header, the rows written before get empty values for the
+    new columns. With count_written, the rows already in the file are counted in written.
+    """
+
+    def __init__(self, out_path, count_written: bool = False):
+        self.out_path = out_path
+        self.written = written_rows(out_path) if count_written else Counter()
+        self.fieldnames = read_header(out_path)
+        # Rows are checked against the header by name, a list would make every row cost columns squared
+        self._columns = set(self.fieldnames)
+        self.batch = []
+        self._out_file = open(out_path, 'a', newline='')
+        self._writer = None
+
+    def add(self, row: dict):
+        if self._writer is None:
+            if not self.fieldnames:
+                self.fieldnames = list(row.keys())
+                self._columns = set(self.fieldnames)
+                csv.writer(self._out_file).writerow(self.fieldnames)
+            self._writer = csv.DictWriter(self._out_file, fieldnames=self.fieldnames, restval='')
+        extra = [name for name in row if name not in self._columns]
+        if extra:
+            self._extend(extra)
+        self.batch.append(row)
+
+    def _extend(self, names: list):
+        """
+        Rewrites the file with names appended to the header. A csv header can't grow in place, this only happens when
+        a new kind of row shows up, so the copy is rare.
+        """
+        self.flush()
+        self._out_file.close()
+        self.fieldnames = self.fieldnames + names
+        self._columns.update(names)
+        directory = os.path.dirname(os.path.abspath(self.out_path))
+        with open(self.out_path, newline='') as in_file, \
+                tempfile.NamedTemporaryFile('w', dir=directory, suffix='.csv', newline='', delete=False) as tmp:
+            reader = csv.reader(in_file)
+            writer = csv.writer(tmp)
+            next(reader, None)
+            writer.writerow(self.fieldnames)
+            for row in reader:
+                writer.writerow(row + [''] * (len(self.fieldnames) - len(row)))
+        os.replace(tmp.name, self.out_path)
+        self._out_file = open(self.out_path, 'a', newline='')
+        self._writer = csv.DictWriter(self._out_file, fieldnames=self.fieldnames, restval='')
+
+    def flush(self):
+        if self.batch:
+            self._writer.writerows(self.batch)
+            self._out_file.flush()
+            self.batch = []
+
+    def close(self):
+        self.flush()
+        self._out_file.close()
+
+
+def write_results(result_queue, out_paths: dict, flush_interval: float, batch_size: int, caches: dict = None,
+                  stop=None, parent_pid: int = None, failed=None):
+    """
+    Writer loop, takes (index, rows) messages from the queue until it receives None, every row being an (image, mask,
+    label, features, config, key) tuple. Rows go to the output of their configuration in out_paths, rows of a named
+    configuration get a Config column. Groups are written in the order of their index, starting at 0, groups which
+    arrive early wait in a reorder buffer. Rows with an index of None are written right away. Outputs are kept open and
+    rows are written in batches, at least every flush_interval seconds. If result caches are given, every row with a
+    label is also stored under its key in the cache of its configuration, and rows served from a cache are not written
+    again if the output already holds them, e.g. when a crashed run is resumed. Without a sentinel, the writer stops
+    once the queue is empty after the stop event is set, or after the parent process died. If rows can't be written,
+    the failed event is set and further rows are taken from the queue but dropped, so no producer blocks on a full
+    queue.
+    """
+    # A Ctrl-C reaches the whole process group, the parent decides when the writer stops
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    caches = caches or {}
+    outputs = {out_path: ResultFile(out_path, bool(caches)) for out_path in set(out_paths.values())}
+    n_batched = 0
+    pending = ReorderBuffer()
+    next_index = 0
+    last_flush = time.monotonic()
+    error = None
+
+    def add_rows(rows):
+        nonlocal n_batched
+        for image, mask, label, features, config, key in rows:
+            output = outputs[out_paths[config]]
+            # A cached row was written before it was cached, the output holds one row per cached label of a pair
+            if label is None and output.written[(image, mask, config)]:
+                output.written[(image, mask, config)] -= 1
+                continue
+            row = OrderedDict([('Image', image), ('Mask', mask)])
+            if config is not None:
+                row['Config'] = config
+            row.update(features)
+            output.add(row)
+            cache = caches.get(config)
+            if cache is not None and label is not None:
+                cache.put(key, image, mask, label, features)
+            n_batched += 1
+
+    def write_group(rows):
+        """ Writes a group unless writing failed before, a group which can't be written stops all writing"""
+        nonlocal error
+        if error:
+            return
+        try:
+            add_rows(rows)
+        except OSError as err:
+            error = err
+            print("Unable to write results, error: {}".format(err))
+            if failed is not None:
+                failed.set()
+
+    while True:
+        try:
+            item = result_queue.get(timeout=flush_interval)
+        except queue.Empty:
+            if (stop is not None and stop.is_set()) or (parent_pid is not None and os.getppid() != parent_pid):
+                break
+            item = ()
+        if item is None:
+            break
+        if item:
+            index, rows = item
+            if index is None:
+                write_group(rows)
+            elif index >= next_index and index not in pending:
+                # A group arrives twice when it is retried after its worker was killed, the first copy is kept
+                pending.add(index, rows)
+                while next_index in pending:
+                    write_group(pending.pop(next_index))
+                    next_index += 1
+        if n_batched and (n_batched >= batch_size or time.monotonic() - last_flush >= flush_interval):
+            for output in outputs.values():
+                output.flush()
+            for cache in caches.values():
+                cache.commit()
+            n_batched = 0
+            last_flush = time.monotonic()
+    # Groups after a missing index, e.g. of a crashed run, are still written, in index order
+    for rows in pending.pop_all():
+        write_group(rows)
+    pending.close()
+    for output in outputs.values():
+        output.close()
+    for cache in caches.values():
+        cache.close()
+
+
+class ResultWriter:
+    """
+    Writes feature rows to csv files from a dedicated process. Extraction code puts (index, rows) messages on the
+    queue, so no extraction process ever has to lock or reopen an output file. The writer is also the only process
+    that adds rows to the result caches. out_path and cache are either a single file and cache, or dicts of them per
+    configuration name.
+    """
+
+    def __init__(self, out_path, flush_interval: float = 1.0, batch_size: int = 64, cache=None):
+        out_paths = out_path if isinstance(out_path, dict) else {None: out_path}
+        caches = cache if isinstance(cache, dict) or cache is None else {None: cache}
+        self.queue = mp.Queue(QUEUE_SIZE)
+        self._stop = mp.Event()
+        self._failed = mp.Event()
+        self._process = mp.Process(target=write_results,
+                                   args=(self.queue, out_paths, flush_interval, batch_size, caches, self._stop,
+                                         os.getpid(), self._failed),
+                                   name='cora-writer')
+
+    def start(self):
+        self._process.start()
+        return self
+
+    def close(self, abort: bool = False):
+        """
+        Signals the writer that no more rows will arrive and waits until everything is written. With abort, e.g. when
+        extraction failed, the writer only writes the rows already queued, so it doesn't wait for a sentinel which may
+        never fit in the queue.
+        """
+        if abort:
+            self._stop.set()
+        else:
+            # The writer may have died with a full queue, so the sentinel is only put while it still runs
+            while self._process.is_alive():
+                try:
+                    self.queue.put(None, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+        self._process.join()
+        if not abort:
+            self.check()
+
+    def check(self):
+        """ Raises if the writer failed to write rows, so extraction doesn't go on for nothing"""
+        if self._failed.is_set():
+            raise RuntimeError('The result writer failed, see the error above')
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, *_):
+        self.close(abort=exc_type is not None)
+
+
+def config_output(out_path, config: str) -> str:
+    """ Returns the result file of a configuration, e.g. results.binwidth25.csv for results.csv"""
+    root, extension = os.path.splitext(out_path)
+    return '{}.{}{}'.format(root, config, extension)
+
+
+def merge_results(in_paths: list, out_path) -> int:
+    """
+    Combines result files, e.g. the outputs of shards, into one file. The header is the union of all input headers,
+    starting with Image and Mask, and rows which occur more than once are written once. Returns the number of rows.
+    """
+    fieldnames = ['Image', 'Mask']
+    for in_path in in_paths:
+        fieldnames += [name for name in read_header(in_path) if name not in fieldnames]
+
+    seen = set()
+    n_rows = 0
+    with open(out_path, 'w', newline='') as out_file:
+        writer = csv.DictWriter(out_file, fieldnames=fieldnames, restval='')
+        writer.writeheader()
+        for in_path in in_paths:
+            with open(in_path, newline='') as in_file:
+                for row in csv.DictReader(in_file):
+                    key = hashlib.sha1('\x1f'.join(row.get(name) or '' for name in fieldnames).encode()).digest()
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    writer.writerow(row)
+                    n_rows += 1
+    return n_rows
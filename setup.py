@@ -14,6 +14,9 @@ st.setup(
         'scipy',
         'SimpleITK',
     ],
+    extras_require={
+        'parquet': ['pyarrow'],
+    },
     python_requires='>=3.6',
     entry_points={
         'console_scripts': [